@@ -3,21 +3,986 @@ import appdaemon.plugins.hass.hassapi as hass
 import sys
 import io
 import colorsys
+import contextlib
+import hashlib
+import http.client
+import json
+import math
+import os
+import re
+import sqlite3
 import ssl
+import time
 
-from threading import Thread
-from PIL import Image, features
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, Lock, Thread
+from PIL import Image, ImageFile, features
 from urllib.parse import urljoin, urlparse
 from urllib.request import urlopen
 from urllib.error import HTTPError, URLError
 
+try:
+    import numpy as np
+except ImportError:  # numpy is only required by the KMeans and Histogram quantization methods
+    np = None
+
 PICTURE_ATTRIBUTES = ["entity_picture_local", "entity_picture"]
+TEMPLATE_ENTITY_PATTERN = re.compile(r"(?<![\w.])([a-z_]+\.[a-z0-9_]+)(?![\w(])")
+# Templates depending on the time, on whole domains or on entities that are not written in them cannot be cached
+UNCACHEABLE_TEMPLATE_PATTERN = re.compile(
+    r"\b(utc)?now\(|\bexpand\(|\b(area|device|label|floor)_\w+\(|\bintegration_entities\("
+    r"|\bstates\b(?!\s*[.(])|\bstates\.[a-z_]+(?![\w.])")
+PREFETCH_LIMIT = 2
+PREFETCH_CACHE_SIZE = 8
+
+REDIRECT_STATUSES = [301, 302, 303, 307, 308]
+MAX_REDIRECTS = 5
+FETCH_CHUNK_SIZE = 16384
+IDLE_CONNECTIONS_PER_HOST = 2
+MAX_VALIDATORS = 256
+
+METRICS_STAGES = ["condition", "resolve", "fetch", "decode", "quantize", "dispatch", "end_to_end"]
+METRICS_QUANTILES = [0.5, 0.9, 0.99]
+
+KMEANS = "KMeans"
+KMEANS_SAMPLES = 16384  # pixels clustered per artwork: enough for stable clusters at a fraction of the 65536 samples cost
+KMEANS_ITERATIONS = 10
+HISTOGRAM = "Histogram"
+HISTOGRAM_BITS = 5
+HISTOGRAM_STRIP_PIXELS = 65536
+
+AMBILIGHT_FRAME_SIZE = 64
+AMBILIGHT_PALETTE_SIZE = 16
+AMBILIGHT_REGIONS = {
+    # name: (left, top, right, bottom) as fractions of the frame
+    "full": (0, 0, 1, 1),
+    "left": (0, 0, 1 / 3, 1),
+    "right": (2 / 3, 0, 1, 1),
+    "top": (0, 0, 1, 1 / 3),
+    "bottom": (0, 2 / 3, 1, 1),
+    "center": (1 / 3, 1 / 3, 2 / 3, 2 / 3),
+    "top_left": (0, 0, 1 / 2, 1 / 2),
+    "top_right": (1 / 2, 0, 1, 1 / 2),
+    "bottom_left": (0, 1 / 2, 1 / 2, 1),
+    "bottom_right": (1 / 2, 1 / 2, 1, 1),
+}
+
+ECHO_COLOR_TOLERANCE = 5  # CIEDE2000 difference between a sent color and the color reported back by Home Assistant
+PROMINENCE_COST = 20  # CIEDE2000 difference traded for giving the dominant color to the most prominent light
+
+RESAMPLE_FILTERS = {
+    "nearest": Image.NEAREST,
+    "box": Image.BOX,
+    "bilinear": Image.BILINEAR,
+    "hamming": Image.HAMMING,
+    "bicubic": Image.BICUBIC,
+    "lanczos": Image.LANCZOS,
+}
 
 COLOR_MODES = {
     "rgb": "rgb_color",
+    "rgbw": "rgbw_color",
+    "rgbww": "rgbww_color",
     "xy": "xy_color",
-    "color_temp": "color_temp",
+    "hs": "hs_color",
+    "color_temp": "color_temp_kelvin",
 }
+NATIVE_COLOR_MODES = ["rgb", "rgbww", "rgbw", "xy", "hs", "color_temp"]  # by preference when a light supports several
+
+
+def rgb_to_xyz(color):
+    """Convert an sRGB color to CIE XYZ (D65 white point)."""
+    linear = [c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4 for c in (v / 255 for v in color)]
+    return [
+        0.4124 * linear[0] + 0.3576 * linear[1] + 0.1805 * linear[2],
+        0.2126 * linear[0] + 0.7152 * linear[1] + 0.0722 * linear[2],
+        0.0193 * linear[0] + 0.1192 * linear[1] + 0.9505 * linear[2],
+    ]
+
+
+def rgb_to_xy(color):
+    """Convert an sRGB color to CIE 1931 xy chromaticity."""
+    xyz = rgb_to_xyz(color)
+    total = sum(xyz)
+    if total == 0:
+        return [0.3127, 0.329]  # D65 white point for black
+    return [round(xyz[0] / total, 4), round(xyz[1] / total, 4)]
+
+
+def full_value_rgb(color):
+    """Scale an RGB color so that its brightest channel is 255, as Home Assistant reports rgb_color."""
+    value = max(color)
+    if value == 0:
+        return list(color)
+    return [round(c * 255 / value) for c in color]
+
+
+def kelvin_to_xy(kelvin):
+    """xy chromaticity of a black body at 1667-25000 K (Kim et al. cubic spline approximation)."""
+    t = min(max(kelvin, 1667), 25000)
+    if t <= 4000:
+        x = -0.2661239e9 / t ** 3 - 0.2343589e6 / t ** 2 + 0.8776956e3 / t + 0.179910
+    else:
+        x = -3.0258469e9 / t ** 3 + 2.1070379e6 / t ** 2 + 0.2226347e3 / t + 0.240390
+    if t <= 2222:
+        y = -1.1063814 * x ** 3 - 1.34811020 * x ** 2 + 2.18555832 * x - 0.20219683
+    elif t <= 4000:
+        y = -0.9549476 * x ** 3 - 1.37418593 * x ** 2 + 2.09137015 * x - 0.16748867
+    else:
+        y = 3.0817580 * x ** 3 - 5.87338670 * x ** 2 + 3.75112997 * x - 0.37001483
+    return [x, y]
+
+
+def xy_to_uv(xy):
+    """Convert xy chromaticity to the CIE 1960 uv space, where color temperature distances are measured."""
+    denominator = -2 * xy[0] + 12 * xy[1] + 3
+    return [4 * xy[0] / denominator, 6 * xy[1] / denominator]
+
+
+def nearest_kelvin(xy, min_kelvin, max_kelvin):
+    """Color temperature between min_kelvin and max_kelvin whose chromaticity is the nearest to xy."""
+    uv = xy_to_uv(xy)
+    candidates = range(int(min_kelvin), int(max_kelvin) + 1, 50)
+    return min(candidates, key=lambda kelvin: math.dist(xy_to_uv(kelvin_to_xy(kelvin)), uv))
+
+
+def rgb_to_lab(color):
+    """Convert an sRGB color to CIE L*a*b* (D65 white point)."""
+    xyz = [v / white for v, white in zip(rgb_to_xyz(color), (0.95047, 1.0, 1.08883))]
+    f = [v ** (1 / 3) if v > 216 / 24389 else (24389 / 27 * v + 16) / 116 for v in xyz]
+    return [116 * f[1] - 16, 500 * (f[0] - f[1]), 200 * (f[1] - f[2])]
+
+
+def lab_to_rgb(lab):
+    """Convert a CIE L*a*b* color (D65 white point) to sRGB, clipping colors out of the sRGB gamut."""
+    f_y = (lab[0] + 16) / 116
+    f = [f_y + lab[1] / 500, f_y, f_y - lab[2] / 200]
+    x, y, z = [v ** 3 if v ** 3 > 216 / 24389 else (116 * v - 16) / (24389 / 27) for v in f]
+    x, z = x * 0.95047, z * 1.08883
+    linear = [
+        3.2406 * x - 1.5372 * y - 0.4986 * z,
+        -0.9689 * x + 1.8758 * y + 0.0415 * z,
+        0.0557 * x - 0.2040 * y + 1.0570 * z,
+    ]
+    return [round(255 * min(max(c * 12.92 if c <= 0.0031308 else 1.055 * c ** (1 / 2.4) - 0.055, 0), 1)) for c in linear]
+
+
+def ciede2000(lab_1, lab_2):
+    """Perceptual difference between two L*a*b* colors. Around 2.3 is barely noticeable."""
+    l_1, a_1, b_1 = lab_1
+    l_2, a_2, b_2 = lab_2
+    c_mean = (math.hypot(a_1, b_1) + math.hypot(a_2, b_2)) / 2
+    g = 0.5 * (1 - math.sqrt(c_mean ** 7 / (c_mean ** 7 + 25 ** 7)))
+    a_1, a_2 = a_1 * (1 + g), a_2 * (1 + g)
+    c_1, c_2 = math.hypot(a_1, b_1), math.hypot(a_2, b_2)
+    h_1 = math.degrees(math.atan2(b_1, a_1)) % 360
+    h_2 = math.degrees(math.atan2(b_2, a_2)) % 360
+
+    delta_l = l_2 - l_1
+    delta_c = c_2 - c_1
+    delta_h = 0 if c_1 * c_2 == 0 else h_2 - h_1
+    if delta_h > 180:
+        delta_h -= 360
+    elif delta_h < -180:
+        delta_h += 360
+    delta_h = 2 * math.sqrt(c_1 * c_2) * math.sin(math.radians(delta_h) / 2)
+
+    l_mean = (l_1 + l_2) / 2
+    c_mean = (c_1 + c_2) / 2
+    h_mean = h_1 + h_2
+    if c_1 * c_2 != 0:
+        h_mean = (h_1 + h_2) / 2 if abs(h_1 - h_2) <= 180 else (h_1 + h_2 + 360) / 2 if h_1 + h_2 < 360 else (h_1 + h_2 - 360) / 2
+    t = (1 - 0.17 * math.cos(math.radians(h_mean - 30)) + 0.24 * math.cos(math.radians(2 * h_mean))
+         + 0.32 * math.cos(math.radians(3 * h_mean + 6)) - 0.20 * math.cos(math.radians(4 * h_mean - 63)))
+    s_l = 1 + 0.015 * (l_mean - 50) ** 2 / math.sqrt(20 + (l_mean - 50) ** 2)
+    s_c = 1 + 0.045 * c_mean
+    s_h = 1 + 0.015 * c_mean * t
+    r_t = (-2 * math.sqrt(c_mean ** 7 / (c_mean ** 7 + 25 ** 7))
+           * math.sin(math.radians(60 * math.exp(-((h_mean - 275) / 25) ** 2))))
+    return math.sqrt((delta_l / s_l) ** 2 + (delta_c / s_c) ** 2 + (delta_h / s_h) ** 2
+                     + r_t * (delta_c / s_c) * (delta_h / s_h))
+
+
+def min_cost_assignment(costs):
+    """Hungarian algorithm: return the column assigned to each row of costs (rows <= columns) minimizing the total cost."""
+    rows, columns = len(costs), len(costs[0])
+    u, v = [0] * (rows + 1), [0] * (columns + 1)
+    match, way = [0] * (columns + 1), [0] * (columns + 1)  # match[column] is the 1-based row assigned to column
+    for row in range(1, rows + 1):
+        match[0] = row
+        column = 0
+        min_values = [math.inf] * (columns + 1)
+        used = [False] * (columns + 1)
+        while match[column] != 0:
+            used[column] = True
+            current_row, delta, next_column = match[column], math.inf, 0
+            for j in range(1, columns + 1):
+                if not used[j]:
+                    cost = costs[current_row - 1][j - 1] - u[current_row] - v[j]
+                    if cost < min_values[j]:
+                        min_values[j], way[j] = cost, column
+                    if min_values[j] < delta:
+                        delta, next_column = min_values[j], j
+            for j in range(columns + 1):
+                if used[j]:
+                    u[match[j]] += delta
+                    v[j] -= delta
+                else:
+                    min_values[j] -= delta
+            column = next_column
+        while column != 0:
+            previous = way[column]
+            match[column] = match[previous]
+            column = previous
+    assignment = [0] * rows
+    for j in range(1, columns + 1):
+        if match[j] != 0:
+            assignment[match[j] - 1] = j - 1
+    return assignment
+
+
+def kmeans_colors(image, colors):
+    """Extract colors with a weighted k-means over a NumPy view of the image pixels.
+
+    Transparent, near-black and near-white pixels are ignored, and saturated pixels weigh more.
+    Centers are seeded with the farthest weighted pixels so that every light gets a distinct color.
+    Colors are sorted by weight, and missing colors are returned as black.
+    """
+    step = math.ceil(math.sqrt(image.width * image.height / KMEANS_SAMPLES))
+    if step > 1:
+        # Sample the pixels before converting them, so that memory does not grow with the image resolution
+        image = image.resize((max(1, image.width // step), max(1, image.height // step)), Image.NEAREST)
+    pixels = np.asarray(image.convert("RGBA")).reshape(-1, 4).astype(np.float32)
+    return weighted_kmeans(pixels[:, :3], pixels[:, 3] / 255, colors)
+
+
+def histogram_colors(image, colors):
+    """Extract colors with the weighted k-means of kmeans_colors over the color histogram of every pixel."""
+    return weighted_kmeans(*color_histogram(image), colors)
+
+
+def color_histogram(image):
+    """Reduce the image to the mean color and alpha-weighted pixel count of each non-empty histogram bin.
+
+    Bins have HISTOGRAM_BITS per channel. The image is read in strips of rows so that memory does not grow with its resolution.
+    """
+    shift = 8 - HISTOGRAM_BITS
+    bins = 1 << (3 * HISTOGRAM_BITS)
+    counts = np.zeros(bins)
+    sums = np.zeros((bins, 3))
+    mode = "RGBA" if image.mode in ["RGBA", "LA", "PA"] or "transparency" in image.info else "RGB"
+    rows = max(1, HISTOGRAM_STRIP_PIXELS // image.width)
+    for top in range(0, image.height, rows):
+        strip = image.crop((0, top, image.width, min(top + rows, image.height))).convert(mode)
+        pixels = np.asarray(strip).reshape(-1, len(mode))
+        index = ((pixels[:, 0] >> shift).astype(np.intp) << (2 * HISTOGRAM_BITS)
+                 | (pixels[:, 1] >> shift).astype(np.intp) << HISTOGRAM_BITS | pixels[:, 2] >> shift)
+        alpha = pixels[:, 3] / 255 if mode == "RGBA" else None  # opaque images skip the weighting
+        counts += np.bincount(index, weights=alpha, minlength=bins)
+        for c in range(3):
+            sums[:, c] += np.bincount(index, weights=pixels[:, c] if alpha is None else alpha * pixels[:, c], minlength=bins)
+    used = counts > 0
+    return sums[used] / counts[used, None], counts[used]
+
+
+def weighted_kmeans(rgb, alpha, colors):
+    """Weighted k-means of rgb colors, each counting for alpha pixels. See kmeans_colors."""
+    high, low = rgb.max(axis=1), rgb.min(axis=1)
+    lightness = (high + low) / 510
+    saturation = np.where(high > 0, (high - low) / np.maximum(high, 1), 0)
+    weights = alpha * (0.25 + saturation)
+    mask = (alpha > 0) & (lightness > 0.05) & (lightness < 0.95)
+    if not mask.any():
+        mask = alpha > 0
+    rgb, weights = rgb[mask], weights[mask]
+    if len(rgb) == 0:
+        return [[0, 0, 0] for _ in range(colors)]
+
+    centers = [np.average(rgb, axis=0, weights=weights)]
+    distances = ((rgb - centers[0]) ** 2).sum(axis=1)
+    for _ in range(1, min(colors, len(rgb))):
+        centers.append(rgb[np.argmax(distances * weights)])
+        distances = np.minimum(distances, ((rgb - centers[-1]) ** 2).sum(axis=1))
+    centers = np.array(centers)
+
+    for _ in range(KMEANS_ITERATIONS):
+        labels = ((rgb[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        totals = np.bincount(labels, weights=weights, minlength=len(centers))
+        sums = np.stack([np.bincount(labels, weights=weights * rgb[:, c], minlength=len(centers)) for c in range(3)], axis=1)
+        new_centers = np.where(totals[:, None] > 0, sums / np.maximum(totals, 1e-9)[:, None], centers)
+        if np.abs(new_centers - centers).max() < 1:
+            centers = new_centers
+            break
+        centers = new_centers
+
+    order = np.argsort(-totals, kind="stable")
+    palette = [[int(round(c)) for c in centers[i]] for i in order if totals[i] > 0]
+    return palette + [[0, 0, 0]] * (colors - len(palette))
+
+
+class Metrics:
+    """Rolling per-stage durations and counters of the artwork pipeline."""
+
+    def __init__(self, window):
+        self.durations = {stage: deque(maxlen=window) for stage in METRICS_STAGES}
+        self.counters = {}
+        self.lock = Lock()
+
+    def timer(self, stage):
+        return StageTimer(self, stage)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.durations[stage].append(seconds)
+
+    def increment(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def percentiles(self, stage):
+        """Return the METRICS_QUANTILES of a stage in seconds, or None if it was never recorded."""
+        with self.lock:
+            durations = sorted(self.durations[stage])
+        if not durations:
+            return None
+        return [durations[min(len(durations) - 1, int(q * len(durations)))] for q in METRICS_QUANTILES]
+
+    def attributes(self):
+        """Percentiles in milliseconds and counters, as Home Assistant sensor attributes."""
+        attributes = dict(self.counters)
+        for stage in METRICS_STAGES:
+            percentiles = self.percentiles(stage)
+            for q, seconds in zip(METRICS_QUANTILES, percentiles or []):
+                attributes["{stage}_p{q:g}_ms".format(stage=stage, q=q * 100)] = round(seconds * 1000, 1)
+        return attributes
+
+    def prometheus(self):
+        """Render the metrics in the Prometheus text exposition format."""
+        lines = ["# TYPE media_lights_sync_stage_seconds summary"]
+        for stage in METRICS_STAGES:
+            percentiles = self.percentiles(stage)
+            for q, seconds in zip(METRICS_QUANTILES, percentiles or []):
+                lines.append('media_lights_sync_stage_seconds{{stage="{stage}",quantile="{q}"}} {seconds:.6f}'.format(
+                    stage=stage, q=q, seconds=seconds))
+            lines.append('media_lights_sync_stage_seconds_count{{stage="{stage}"}} {count}'.format(
+                stage=stage, count=len(self.durations[stage])))
+        lines.append("# TYPE media_lights_sync_events_total counter")
+        for counter, value in sorted(self.counters.items()):
+            lines.append('media_lights_sync_events_total{{event="{counter}"}} {value}'.format(counter=counter, value=value))
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.monotonic()
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.stage, time.monotonic() - self.start)
+
+
+class NullMetrics:
+    """Metrics recorder used when metrics are disabled."""
+
+    def timer(self, stage):
+        return NULL_TIMER
+
+    def record(self, stage, seconds):
+        pass
+
+    def increment(self, counter, amount=1):
+        pass
+
+
+NULL_TIMER = contextlib.nullcontext()
+
+
+class ArtworkFetcher:
+    """Download artworks over pooled keep-alive connections, with timeouts and a maximum download size."""
+
+    def __init__(self, verify_cert, connect_timeout, read_timeout, max_size):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_size = max_size
+        self.ssl_context = ssl.create_default_context()
+        if not verify_cert:
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.idle_connections = {}  # (scheme, netloc) -> [HTTPConnection]
+        self.validators = OrderedDict()  # url without query -> (etag, last_modified, digest, query)
+        self.lock = Lock()
+
+    def fetch(self, url, is_cached=None):
+        """Return the artwork (bytes, digest) at url, raising HTTPError or URLError on failures.
+
+        The validators of the last artwork received from the same path are only sent if is_cached(digest) tells that
+        its palette is still known, and (None, digest) is returned if the server replies 304 Not Modified. Validators
+        are shared by cache-busting query strings, but as some servers select the artwork with them, only a strong
+        ETag is sent when the query string changed.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            parsed = urlparse(url)
+            if parsed.scheme not in ["http", "https"]:
+                data = self.read_body(urlopen(url, timeout=self.read_timeout), url)
+                return data, hashlib.sha1(data).hexdigest()
+            validator_key = parsed._replace(query="", fragment="").geturl()
+            with self.lock:
+                validators = self.validators.get(validator_key, None) if is_cached is not None else None
+            headers = self.conditional_headers(validators, parsed.query) if validators and is_cached(validators[2]) else {}
+            try:
+                connection, response = self.request(parsed, headers)
+            except (OSError, http.client.HTTPException) as error:
+                raise URLError(error)
+
+            if response.status == 304 and headers:
+                response.read()
+                self.release(parsed, connection, response)
+                return None, validators[2]
+
+            if response.status in REDIRECT_STATUSES and response.getheader("Location"):
+                response.read()
+                self.release(parsed, connection, response)
+                url = urljoin(url, response.getheader("Location"))
+                continue
+            if response.status >= 400:
+                response.read()
+                self.release(parsed, connection, response)
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            try:
+                data = self.read_body(response, url)
+            except URLError:
+                connection.close()
+                raise
+            except (OSError, http.client.HTTPException) as error:
+                connection.close()
+                raise URLError(error)
+            self.release(parsed, connection, response)
+            digest = hashlib.sha1(data).hexdigest()
+            self.store_validators(validator_key, parsed.query, response, digest)
+            return data, digest
+        raise URLError("Too many redirects for {url}".format(url=url))
+
+    def conditional_headers(self, validators, query):
+        etag, last_modified, _digest, validated_query = validators
+        headers = {}
+        if query != validated_query:
+            # Another query string may select another artwork: only an identical representation matches a strong ETag
+            if etag is not None and not etag.startswith("W/"):
+                headers["If-None-Match"] = etag
+            return headers
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def store_validators(self, key, query, response, digest):
+        etag, last_modified = response.getheader("ETag"), response.getheader("Last-Modified")
+        if etag is None and last_modified is None:
+            return
+        with self.lock:
+            self.validators[key] = (etag, last_modified, digest, query)
+            self.validators.move_to_end(key)
+            while len(self.validators) > MAX_VALIDATORS:
+                self.validators.popitem(last=False)
+
+    def request(self, parsed, headers):
+        """Send a GET on an idle connection of the host, retrying once on a fresh one if it was closed."""
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        connection = self.acquire(parsed)
+        for attempt in range(2):
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                    connection.sock.settimeout(self.read_timeout)
+                connection.request("GET", path, headers=headers)
+                return connection, connection.getresponse()
+            except (ConnectionError, http.client.RemoteDisconnected, http.client.BadStatusLine):
+                connection.close()
+                if attempt == 1:
+                    raise
+                connection = self.new_connection(parsed)
+
+    def read_body(self, response, url):
+        """Read the response in chunks, checking the image dimensions as soon as its header is received."""
+        parser = ImageFile.Parser()
+        chunks = []
+        size = 0
+        while True:
+            chunk = response.read(FETCH_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > self.max_size:
+                raise URLError("Artwork is larger than {max_size} bytes: {url}".format(max_size=self.max_size, url=url))
+            chunks.append(chunk)
+            if parser is not None:
+                parser.feed(chunk)
+                if parser.image is not None:
+                    width, height = parser.image.size
+                    if Image.MAX_IMAGE_PIXELS is not None and width * height > Image.MAX_IMAGE_PIXELS:
+                        raise URLError("Artwork is too large ({width}x{height}): {url}".format(width=width, height=height, url=url))
+                    parser = None  # the image is decoded later, once downscaled
+        return b"".join(chunks)
+
+    def acquire(self, parsed):
+        with self.lock:
+            idle_connections = self.idle_connections.get((parsed.scheme, parsed.netloc), [])
+            if idle_connections:
+                return idle_connections.pop()
+        return self.new_connection(parsed)
+
+    def new_connection(self, parsed):
+        if parsed.scheme == "https":
+            return http.client.HTTPSConnection(parsed.netloc, timeout=self.connect_timeout, context=self.ssl_context)
+        return http.client.HTTPConnection(parsed.netloc, timeout=self.connect_timeout)
+
+    def release(self, parsed, connection, response):
+        """Keep the connection for the next artwork of the host, unless the server closes it."""
+        if response.will_close:
+            connection.close()
+            return
+        with self.lock:
+            idle_connections = self.idle_connections.setdefault((parsed.scheme, parsed.netloc), [])
+            if len(idle_connections) < IDLE_CONNECTIONS_PER_HOST:
+                idle_connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            for idle_connections in self.idle_connections.values():
+                for connection in idle_connections:
+                    connection.close()
+            self.idle_connections = {}
+
+
+class SharedArtworkPipeline:
+    """Process-wide registry sharing artwork processing between MediaLightsSync apps.
+
+    Apps with the same extraction settings register their light count. Concurrent requests for the same
+    artwork are processed once (single-flight) at the highest registered light count, and each app slices
+    the palette it needs.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.light_counts = {}  # settings -> {app id: light count}
+        self.in_flight = {}  # (settings, url) -> Future
+        self.deduplicated = 0
+
+    def register(self, settings, app_id, lights):
+        with self.lock:
+            for light_counts in self.light_counts.values():
+                light_counts.pop(app_id, None)
+            self.light_counts.setdefault(settings, {})[app_id] = lights
+
+    def unregister(self, app_id):
+        with self.lock:
+            for light_counts in self.light_counts.values():
+                light_counts.pop(app_id, None)
+
+    def light_count(self, settings):
+        with self.lock:
+            return max(self.light_counts.get(settings, {}).values(), default=0)
+
+    def get_colors(self, settings, url, compute):
+        """Return compute(), sharing its result with every concurrent request of the same artwork."""
+        key = (settings, url)
+        with self.lock:
+            flight = self.in_flight.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = Future()
+            else:
+                self.deduplicated += 1
+        if not leader:
+            return flight.result()
+
+        try:
+            colors = compute()
+            flight.set_result(colors)
+            return colors
+        except BaseException as error:
+            flight.set_exception(error)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+
+SHARED_PIPELINE = SharedArtworkPipeline()
+
+
+class PaletteCache:
+    """Bounded LRU cache of extracted palettes, keyed by artwork URL and content digest."""
+
+    def __init__(self, size):
+        self.size = size
+        self.urls = OrderedDict()  # url -> digest
+        self.palettes = OrderedDict()  # digest -> colors
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, url=None, digest=None):
+        """Return the cached colors for url or digest, or None."""
+        with self.lock:
+            if digest is None:
+                digest = self.urls.get(url, None)
+            colors = self.palettes.get(digest, None) if digest is not None else None
+            if colors is None:
+                return None
+            self.palettes.move_to_end(digest)
+            if url is not None and url in self.urls:
+                self.urls.move_to_end(url)
+            return colors
+
+    def put(self, url, digest, colors):
+        """Store the colors of an artwork, evicting the least recently used ones. A None url only caches the digest."""
+        if self.size <= 0:
+            return
+        with self.lock:
+            if url is not None:
+                self.urls[url] = digest
+                self.urls.move_to_end(url)
+            self.palettes[digest] = colors
+            self.palettes.move_to_end(digest)
+            while len(self.urls) > self.size:
+                self.urls.popitem(last=False)
+            while len(self.palettes) > self.size:
+                self.palettes.popitem(last=False)
+
+    def record(self, hit):
+        """Count a palette lookup for an artwork event."""
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        return "hits: {hits}, misses: {misses}, size: {size}/{max_size}".format(
+            hits=self.hits, misses=self.misses, size=len(self.palettes), max_size=self.size)
+
+
+class PaletteStore:
+    """SQLite palette store persisting extracted palettes across AppDaemon restarts."""
+
+    def __init__(self, path, size, method):
+        self.size = size
+        self.method = method
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS palettes ("
+                                    "url TEXT, digest TEXT, method TEXT, lights INTEGER, colors TEXT, last_used REAL, "
+                                    "PRIMARY KEY (digest, method, lights))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS palettes_url ON palettes (url, method, lights)")
+
+    def get(self, lights, url=None, digest=None):
+        """Return the stored (digest, colors) of lights colors for url or digest, or None."""
+        column, value = ("digest", digest) if digest is not None else ("url", url)
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT digest, colors FROM palettes WHERE {column} = ? AND method = ? AND lights = ? "
+                "ORDER BY last_used DESC, rowid DESC LIMIT 1".format(column=column), (value, self.method, lights)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE palettes SET last_used = ? WHERE digest = ? AND method = ? AND lights = ?",
+                                    (time.time(), row[0], self.method, lights))
+        return row[0], json.loads(row[1])
+
+    def put(self, lights, url, digest, colors):
+        """Store the colors of an artwork, evicting the least recently used rows above size."""
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO palettes VALUES (?, ?, ?, ?, ?, ?)",
+                                    (url, digest, self.method, lights, json.dumps(colors), time.time()))
+            self.connection.execute("DELETE FROM palettes WHERE rowid IN "
+                                    "(SELECT rowid FROM palettes ORDER BY last_used DESC, rowid DESC LIMIT -1 OFFSET ?)", (self.size,))
+
+    def recent(self, lights, count):
+        """Return the (url, digest, colors) of the most recently used palettes, oldest first."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT url, digest, colors FROM palettes WHERE method = ? AND lights = ? ORDER BY last_used DESC, rowid DESC LIMIT ?",
+                (self.method, lights, count)).fetchall()
+        return [(url, digest, json.loads(colors)) for url, digest, colors in reversed(rows)]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class LightDispatcher:
+    """Persistent worker threads sending light commands, keeping only the latest pending command of each light.
+
+    Pending commands sharing the same service and attributes are batched into a single service call.
+    """
+
+    def __init__(self, app, threads, rate_limit):
+        self.app = app
+        self.min_interval = 1 / rate_limit if rate_limit else 0
+        self.next_call = 0
+        self.pending = OrderedDict()  # light -> (service, attributes, enqueued_at)
+        self.in_flight = set()
+        self.condition = Condition()
+        self.running = True
+        self.calls = 0
+        self.updates = 0
+        self.replaced = 0
+        self.latencies = deque(maxlen=100)
+        for i in range(max(threads, 1)):
+            Thread(target=self.run, name="media_lights_sync_dispatcher_{i}".format(i=i), daemon=True).start()
+
+    def send(self, entity, service, attributes):
+        """Queue a turn_on or turn_off service call for a light, replacing its pending command if any."""
+        self.send_many([(entity, service, attributes)])
+
+    def send_many(self, commands):
+        """Queue the (entity, service, attributes) commands of several lights at once, so that identical ones are batched."""
+        if not commands:
+            return
+        now = time.monotonic()
+        with self.condition:
+            for entity, service, attributes in commands:
+                if entity in self.pending:
+                    self.replaced += 1
+                self.pending[entity] = (service, attributes, now)
+            self.condition.notify(len(commands))
+
+    def next_batch(self):
+        """Wait for lights that have the same pending command and no command in flight."""
+        with self.condition:
+            while True:
+                if not self.running:
+                    return None
+                ready = [entity for entity in self.pending if entity not in self.in_flight]
+                if ready:
+                    break
+                self.condition.wait()
+            service, attributes, _enqueued_at = self.pending[ready[0]]
+            batch = [entity for entity in ready if self.pending[entity][:2] == (service, attributes)]
+            enqueued_at = [self.pending.pop(entity)[2] for entity in batch]
+            self.in_flight.update(batch)
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.min_interval
+        return batch, service, attributes, enqueued_at, delay
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            entities, service, attributes, enqueued_at, delay = batch
+            if delay > 0:
+                time.sleep(delay)  # global rate limit
+            try:
+                if len(entities) == 1:
+                    getattr(self.app, service)(entities[0], **attributes)
+                else:
+                    self.app.call_service("light/" + service, entity_id=entities, **attributes)
+            except Exception as error:
+                self.app.error("Unable to update {entities} light(s): {error}".format(entities=entities, error=error))
+            now = time.monotonic()
+            for enqueued in enqueued_at:
+                self.app.metrics.record("dispatch", now - enqueued)
+            with self.condition:
+                self.in_flight.difference_update(entities)
+                self.calls += 1
+                self.updates += len(entities)
+                self.latencies.extend(now - enqueued for enqueued in enqueued_at)
+                idle = not self.pending and not self.in_flight
+                self.condition.notify_all()
+            if idle:
+                self.app.log("Light commands {stats}".format(stats=self.stats()))
+
+    def wait_idle(self, timeout=10):
+        """Block until every queued command has been sent."""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.in_flight, timeout)
+
+    def latency(self):
+        """Median delay in seconds between queuing a command and the end of its service call."""
+        with self.condition:
+            latencies = sorted(self.latencies)
+        return latencies[len(latencies) // 2] if latencies else 0
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.pending.clear()
+            self.condition.notify_all()
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return "calls: 0"
+        return "calls: {calls}, lights: {updates}, replaced: {replaced}, latency p50: {p50:.0f} ms, max: {max:.0f} ms".format(
+            calls=self.calls, updates=self.updates, replaced=self.replaced,
+            p50=latencies[len(latencies) // 2] * 1000, max=latencies[-1] * 1000)
+
+
+class LightInterpolator:
+    """Single thread moving the lights from their current colors to a new palette in interpolated L*a*b* frames.
+
+    Frames are spaced by at least the measured service call latency, and a new palette cancels the frames left to send.
+    """
+
+    def __init__(self, app, duration, max_frames):
+        self.app = app
+        self.duration = duration
+        self.max_frames = max(max_frames, 1)
+        self.transition = None  # (lights {entity: (start_lab, end_lab, color)}, brightness, frames, interval)
+        self.generation = 0
+        self.cancelled = 0
+        self.condition = Condition()
+        self.running = True
+        Thread(target=self.run, name="media_lights_sync_interpolator", daemon=True).start()
+
+    def start(self, colors, brightness):
+        """Interpolate every light of colors {entity: rgb color} from its last applied color."""
+        interval = max(self.duration / self.max_frames, self.app.dispatcher.latency())
+        frames = max(1, min(self.max_frames, round(self.duration / interval)))
+        lights = {}
+        for entity, color in colors.items():
+            current_color = self.app.get_applied_color(entity)
+            if current_color is not None:
+                lights[entity] = (rgb_to_lab(current_color), rgb_to_lab(color), color)
+            else:
+                lights[entity] = (None, None, color)  # unknown current color: set the new one at the last frame
+        with self.condition:
+            if self.transition is not None:
+                self.cancelled += 1
+            self.transition = (lights, brightness, frames, interval)
+            self.generation += 1
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            if self.transition is not None:
+                self.cancelled += 1
+            self.transition = None
+            self.generation += 1
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.transition is not None or not self.running)
+                if not self.running:
+                    return
+                generation = self.generation
+                lights, brightness, frames, interval = self.transition
+            for frame in range(1, frames + 1):
+                if frame > 1 and not self.wait_frame(generation, interval):
+                    break
+                states = []
+                for entity, (start, end, color) in lights.items():
+                    if frame == frames:
+                        states.append(dict(new_state="on", entity=entity, color=color, brightness=brightness))
+                    elif start is not None:
+                        ratio = frame / frames
+                        states.append(dict(new_state="on", entity=entity, brightness=brightness,
+                                           color=lab_to_rgb([s + (e - s) * ratio for s, e in zip(start, end)])))
+                with self.condition:
+                    if self.generation != generation or not self.running:
+                        break  # cancelled while the frame was computed
+                    self.app.set_lights(states)
+            with self.condition:
+                if self.generation == generation:
+                    self.transition = None
+                    self.condition.notify_all()
+
+    def wait_frame(self, generation, interval):
+        """Wait for the next frame, and return False if the transition was cancelled in the meantime."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation or not self.running, interval)
+            return self.generation == generation and self.running
+
+    def wait_idle(self, timeout=10):
+        """Block until the current transition has sent its last frame."""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.transition is None, timeout)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.transition = None
+            self.condition.notify_all()
+
+
+class AmbilightLoop:
+    """Thread pulling frames at a fixed rate while active and applying one color per light region.
+
+    Frames are skipped when processing falls behind, and the rate is lowered to keep the thread CPU time under cpu_budget.
+    """
+
+    def __init__(self, app, fps, cpu_budget):
+        self.app = app
+        self.interval = 1 / fps
+        self.cpu_budget = cpu_budget
+        self.next_frame = 0
+        self.frames = 0
+        self.skipped = 0
+        self.throttled = 0
+        self.condition = Condition()
+        self.active = False
+        self.running = True
+        Thread(target=self.run, name="media_lights_sync_ambilight", daemon=True).start()
+
+    def resume(self):
+        with self.condition:
+            if not self.active:
+                self.active = True
+                self.next_frame = time.monotonic()
+                self.condition.notify_all()
+
+    def pause(self):
+        with self.condition:
+            self.active = False
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.active or not self.running)
+                if not self.running:
+                    return
+                delay = self.next_frame - time.monotonic()
+                if delay > 0:
+                    self.condition.wait_for(lambda: not self.active or not self.running, delay)
+                    continue
+            started, cpu_started = time.monotonic(), time.thread_time()
+            try:
+                self.app.sync_frame()
+            except Exception as error:
+                self.app.error("Unable to process ambilight frame: {error}".format(error=error))
+            self.frame_done(started, time.thread_time() - cpu_started)
+
+    def frame_done(self, started, cpu_time):
+        """Schedule the next frame within the CPU budget, skipping the frames missed while processing."""
+        period = max(self.interval, cpu_time / self.cpu_budget)
+        if period > self.interval:
+            self.throttled += 1
+        now = time.monotonic()
+        missed = int((now - started) // period)
+        with self.condition:
+            self.frames += 1
+            self.skipped += missed
+            self.next_frame = started + (missed + 1) * period
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
 
 
 class MediaLightsSync(hass.Hass):
@@ -26,100 +991,610 @@ class MediaLightsSync(hass.Hass):
     def initialize(self):
         """Initialize the app and listen for media_player photo_attribute changes."""
         args = self.args
+        self.metrics, self.metrics_sensor = self.start_metrics(args.get("metrics", False))
         self.lights = args["lights"]
+        self.light_capabilities = self.load_light_capabilities()
         self.ha_url = args.get("ha_url", None)
         self.verify_cert = args.get("verify_cert", True)
+        self.fetcher = ArtworkFetcher(self.verify_cert, args.get("connect_timeout", 5), args.get("read_timeout", 10),
+                                      int(args.get("max_download_size", 20) * 1024 * 1024))
         self.condition = args.get("condition")
+        self.condition_result = None
+        self.condition_version = 0
+        self.condition_lock = Lock()
+        self.condition_cacheable = self.listen_condition_entities()
         self.transition = args.get("transition", None)
         self.reset_lights_after = args.get("reset_lights_after", False)
         self.use_saturated_colors = args.get("use_saturated_colors", False)
         self.brightness = None if args.get("use_current_brightness", False) else 255
         self.quantization_method = self.get_quantization_method(args.get("quantization_method", None))
+        self.max_image_size = args.get("max_image_size", None)
+        self.resample_filter = self.get_resample_filter(args.get("resample_filter", None))
+        self.share_artwork = args.get("share_artwork", False)
+        if self.share_artwork:
+            SHARED_PIPELINE.register(self.extraction_settings(), id(self), len(self.lights))
+        self.prefetch_attributes = args.get("prefetch_attributes", [])
+        palette_cache_size = args.get("palette_cache_size", 0)
+        if self.prefetch_attributes and palette_cache_size < PREFETCH_CACHE_SIZE:
+            palette_cache_size = PREFETCH_CACHE_SIZE  # prefetched palettes are kept in the palette cache
+        self.palette_cache = PaletteCache(palette_cache_size)
+        self.palette_store = self.open_palette_store(args.get("palette_store", None), args.get("palette_store_size", 1000),
+                                                     args.get("quantization_method", None))
+        self.worker_queue_size = args.get("worker_queue_size", 10)
+        self.workers = self.start_workers(args.get("worker_threads", 0))
+        self.debounce = args.get("debounce", 0)
+        self.dispatcher = LightDispatcher(self, args.get("light_threads", 4), args.get("light_rate_limit", None))
+        self.interpolator = None
+        if args.get("interpolation", 0) > 0:
+            self.interpolator = LightInterpolator(self, args["interpolation"], args.get("interpolation_frames", 10))
+        self.color_delta_threshold = args.get("color_delta_threshold", None)
+        self.color_assignment = args.get("color_assignment", "palette")
+        self.light_weights = self.get_light_weights(args.get("light_weights", None))
+        self.last_applied_states = {}
+        for light in self.lights:
+            self.listen_state(self.light_changed, light, attribute="all")
+        self.suppressed_commands = 0
+        self.latest_jobs = {}
+        self.debounce_tokens = {}  # entity -> token of its latest debounced artwork
+        self.coalesced_jobs = 0
 
         self.media_player_callbacks = {}
         self.initial_lights_states = None
         media_players = args["media_player"] if isinstance(args["media_player"], list) else [args["media_player"]]
 
-        for media_player in media_players:
+        self.ambilight = self.start_ambilight(args.get("ambilight", None), media_players)
+        for media_player in media_players if self.ambilight is None else []:
             self.log("Listening for picture changes on '{entity}'".format(entity=media_player))
             for photo_attribute in PICTURE_ATTRIBUTES:
                 self.listen_state(self.change_lights_color, media_player, attribute=photo_attribute)
+            for prefetch_attribute in self.prefetch_attributes:
+                self.listen_state(self.prefetch_artwork, media_player, attribute=prefetch_attribute)
 
     def change_lights_color(self, entity, attribute, old_url, new_url, kwargs):
         """Callback when a entity_picture has changed."""
-        if new_url == old_url or not self.can_change_colors():
+        received_at = time.monotonic()
+        if new_url == old_url:
             return
+        with self.metrics.timer("condition"):
+            if not self.can_change_colors():
+                return
 
         if new_url is not None:
             self.store_initial_lights_states()
             log_message = "New picture received from '{entity}' ({attribute})\n"
-            current_pictures = [self.get_state(entity, attribute=attribute) for attribute in PICTURE_ATTRIBUTES]
+            resolve_started = time.monotonic()
+            attributes = self.get_state(entity, attribute="all")["attributes"]  # one state snapshot for the whole event
+            current_pictures = [attributes.get(attribute, None) for attribute in PICTURE_ATTRIBUTES]
 
             if self.media_player_callbacks.get(entity, None) == current_pictures:
                 # Image already processed from another callback
                 return self.log(log_message.format(entity=entity, attribute=attribute + "; skipped"))
             self.log(log_message.format(entity=entity, attribute=attribute))
+            url = self.format_url(new_url, entity, attribute)
+            self.metrics.record("resolve", time.monotonic() - resolve_started)
+            self.metrics.increment("artworks")
+            self.media_player_callbacks[entity] = current_pictures
+            if not self.schedule_artwork(entity, url, received_at):
+                self.media_player_callbacks.pop(entity, None)
+        else:
+            self.new_debounce_token(entity)
+            self.new_job(entity)
+            self.reset_lights()
 
-            try:
-                url = self.format_url(new_url, entity, attribute)
-                rgb_colors = self.get_colors(url)
-            except (HTTPError, URLError) as error:
-                self.error("Unable to fetch artwork: {error}\nURL: {url}\n".format(url=url, error=error))
-                return
+    def start_ambilight(self, config, media_players):
+        """Start the ambilight loop, active while one of the media players is playing."""
+        if not config:
+            return None
+        self.ambilight_source = config["source"]
+        self.ambilight_regions = self.get_ambilight_regions(config.get("regions", None))
+        self.ambilight_digest = None
+        self.media_players = media_players
+        if self.prefetch_attributes:
+            self.log("Artwork pictures and prefetch_attributes are ignored in ambilight mode")
+        else:
+            self.log("Artwork pictures are ignored in ambilight mode")
+        self.ambilight = AmbilightLoop(self, config.get("fps", 2), config.get("cpu_budget", 0.25))
+        for media_player in media_players:
+            self.log("Syncing lights with '{source}' while '{entity}' is playing".format(source=self.ambilight_source, entity=media_player))
+            self.listen_state(self.toggle_ambilight, media_player)
+        self.toggle_ambilight(None, "state", None, None, None)  # a media player may already be playing
+        return self.ambilight
 
-            self.media_player_callbacks[entity] = current_pictures
-            for i in range(len(self.lights)):
-                color = self.get_saturated_color(rgb_colors[i]) if self.use_saturated_colors else rgb_colors[i]
-                if color == [0, 0, 0] or len(color) == 0:
-                    self.log("Skipped black color for '{entity}' light".format(entity=self.lights[i]))
-                    continue
-                self.set_light("on", self.lights[i], color=color, brightness=self.brightness, transition=self.transition)
+    def toggle_ambilight(self, entity, attribute, old_state, new_state, kwargs):
+        """Callback when a media player state changed: run the ambilight loop while one of them is playing."""
+        if any(self.get_state(media_player) == "playing" for media_player in self.media_players) and self.can_change_colors():
+            self.store_initial_lights_states()
+            self.ambilight.resume()
         else:
+            self.ambilight.pause()
+            self.ambilight_digest = None
             self.reset_lights()
 
+    def sync_frame(self):
+        """Apply the dominant color of each light region of the current ambilight frame.
+
+        Frames bypass get_colors: they are region-quantized at a fixed small size, and the palette cache would only
+        hold frames that are never seen again, so unchanged frames are recognized by their digest instead.
+        """
+        source = self.ambilight_source
+        url = self.get_state(source, attribute="entity_picture") if source.startswith("camera.") else source
+        if url is None:
+            return  # camera unavailable
+        data, digest = self.fetch_image(self.format_url(url, source, "entity_picture"))
+        if digest == self.ambilight_digest:
+            return  # unchanged frame
+        self.ambilight_digest = digest
+        self.metrics.increment("ambilight_frames")
+        self.set_lights([dict(new_state="on", entity=entity, color=color, brightness=self.brightness)
+                         for entity, color in zip(self.lights, self.extract_region_colors(data, self.ambilight_regions)) if color != [0, 0, 0]])
+
+    def get_ambilight_regions(self, regions):
+        """Frame boxes of each light, by region name or [left, top, right, bottom]. Vertical strips by default."""
+        count = len(self.lights)
+        if regions is not None and len(regions) != count:
+            self.log("Ambilight regions must have one region per light, using vertical strips.")
+            regions = None
+        if regions is None:
+            return [(i / count, 0, (i + 1) / count, 1) for i in range(count)]
+        boxes = []
+        for region in regions:
+            if isinstance(region, str) and region not in AMBILIGHT_REGIONS:
+                self.log("Ambilight region '{region}' is unsupported, using 'full'.".format(region=region))
+                region = "full"
+            boxes.append(AMBILIGHT_REGIONS[region] if isinstance(region, str) else tuple(region))
+        return boxes
+
+    def extract_region_colors(self, data, regions):
+        """Quantize a downscaled frame once, and return the dominant palette color of each region box."""
+        with self.metrics.timer("decode"):
+            im = Image.open(io.BytesIO(data))
+            size = (AMBILIGHT_FRAME_SIZE, AMBILIGHT_FRAME_SIZE)
+            if im.format == "JPEG":
+                im.draft("RGB", size)
+            im.thumbnail(size, resample=Image.BOX)
+            im = self.convert_rgba_to_rgb(im) if im.mode == "RGBA" else im.convert("RGB")
+        with self.metrics.timer("quantize"):
+            method = None if self.quantization_method in [KMEANS, HISTOGRAM] else self.quantization_method
+            quantized = im.quantize(colors=AMBILIGHT_PALETTE_SIZE, method=method)
+            palette = quantized.getpalette()
+            colors = []
+            for left, top, right, bottom in regions:
+                box = (int(left * im.width), int(top * im.height), max(int(left * im.width) + 1, round(right * im.width)),
+                       max(int(top * im.height) + 1, round(bottom * im.height)))
+                _count, index = max(quantized.crop(box).getcolors(256))
+                colors.append(palette[index * 3:index * 3 + 3])
+            return colors
+
+    def prefetch_artwork(self, entity, attribute, old_value, new_value, kwargs):
+        """Callback when the next artwork(s) of a media player queue changed: extract their colors ahead of time."""
+        if new_value is None or new_value == old_value or not self.can_change_colors():
+            return
+        urls = new_value if isinstance(new_value, list) else [new_value]
+        for url in [url for url in urls if isinstance(url, str)][:PREFETCH_LIMIT]:
+            self.log("Prefetching next picture from '{entity}' ({attribute})".format(entity=entity, attribute=attribute))
+            self.submit_prefetch(self.format_url(url, entity, attribute))
+
+    def submit_prefetch(self, url):
+        """Extract the colors of url in the background, at a lower priority than artwork jobs.
+
+        Prefetches share the worker pool, where artwork jobs evict them from a full queue, or run on their own thread
+        if worker_threads is not set, so that they never delay the callback thread.
+        """
+        with self.jobs_lock:
+            if self.workers is None and len(self.queued_prefetches) >= PREFETCH_LIMIT:
+                self.log("Prefetch queue is full, skipping prefetch of {url}".format(url=url))
+                return None
+        if self.workers is None:
+            future = self.prefetcher.submit(self.prefetch_colors, url)
+        else:
+            future = self.submit_job(self.prefetch_colors, url)
+            if future is None:
+                return None
+        with self.jobs_lock:
+            if not future.done():
+                self.queued_prefetches.add(future)
+        future.add_done_callback(self.prefetch_done)
+        return future
+
+    def prefetch_done(self, future):
+        with self.jobs_lock:
+            self.queued_prefetches.discard(future)
+
+    def prefetch_colors(self, url):
+        try:
+            self.get_colors(url)
+            self.metrics.increment("prefetched_artworks")
+        except (HTTPError, URLError) as error:
+            self.log("Unable to prefetch artwork: {error}\nURL: {url}".format(url=url, error=error))
+
+    def schedule_artwork(self, entity, url, received_at=None):
+        """Schedule the artwork of entity, superseding its older artwork jobs. Return False if the job was dropped."""
+        if self.debounce > 0:
+            token = self.new_debounce_token(entity)
+            self.run_in(self.run_artwork_job, self.debounce, entity=entity, url=url, token=token, received_at=received_at)
+            return True
+        return self.submit_artwork_job(entity, url, received_at)
+
+    def new_debounce_token(self, entity):
+        with self.jobs_lock:
+            self.debounce_tokens[entity] = self.debounce_tokens.get(entity, 0) + 1
+            return self.debounce_tokens[entity]
+
+    def run_artwork_job(self, kwargs):
+        """Submit a debounced artwork job if no newer artwork was received in the meantime."""
+        entity = kwargs["entity"]
+        with self.jobs_lock:
+            superseded = self.debounce_tokens.get(entity, None) != kwargs["token"]
+        if superseded:
+            self.count_coalesced(entity)
+        elif not self.submit_artwork_job(entity, kwargs["url"], kwargs["received_at"]):
+            self.media_player_callbacks.pop(entity, None)
+
+    def submit_artwork_job(self, entity, url, received_at):
+        """Submit the artwork job of entity, replacing its queued job if the worker queue is full.
+
+        The job only supersedes the older jobs of entity once accepted, so that a dropped job never cancels them.
+        """
+        if self.workers is None:
+            self.sync_lights(entity, url, self.new_job(entity), received_at)
+            return True
+
+        with self.jobs_lock:
+            full = self.pending_jobs >= self.worker_queue_size
+            prefetches = list(self.queued_prefetches) if full else []
+            queued = self.queued_jobs.get(entity, None) if full else None
+        if any(prefetch.cancel() for prefetch in prefetches):  # job_done frees its slot
+            self.metrics.increment("evicted_prefetches")
+            self.log("Worker queue is full, evicted a queued prefetch for the artwork of '{entity}'".format(entity=entity))
+        elif queued is not None and queued.cancel():
+            self.metrics.increment("replaced_jobs")
+            self.log("Worker queue is full, replaced the queued artwork job of '{entity}'".format(entity=entity))
+            self.count_coalesced(entity)
+        with self.jobs_lock:
+            if self.pending_jobs >= self.worker_queue_size:
+                self.metrics.increment("dropped_jobs")
+                self.log("Worker queue is full ({size} jobs), dropping artwork job".format(size=self.pending_jobs))
+                return False
+            self.pending_jobs += 1
+            self.latest_jobs[entity] = self.latest_jobs.get(entity, 0) + 1
+            job = self.latest_jobs[entity]
+            future = self.workers.submit(self.sync_lights, entity, url, job, received_at)
+            self.queued_jobs[entity] = future
+        future.add_done_callback(self.job_done)
+        return True
+
+    def new_job(self, entity):
+        with self.jobs_lock:
+            self.latest_jobs[entity] = self.latest_jobs.get(entity, 0) + 1
+            return self.latest_jobs[entity]
+
+    def is_superseded(self, entity, job):
+        """Return True and count the job as coalesced if a newer job exists for entity."""
+        with self.jobs_lock:
+            if job is None or self.latest_jobs.get(entity, None) == job:
+                return False
+        self.count_coalesced(entity)
+        return True
+
+    def count_coalesced(self, entity):
+        with self.jobs_lock:
+            self.coalesced_jobs += 1
+            count = self.coalesced_jobs
+        self.metrics.increment("coalesced_jobs")
+        self.log("Dropped superseded artwork job for '{entity}' ({count} coalesced)".format(entity=entity, count=count))
+
+    def sync_lights(self, entity, url, job=None, received_at=None):
+        """Fetch the colors of the artwork at url and apply them to the lights."""
+        if self.is_superseded(entity, job):
+            return
+        try:
+            rgb_colors = self.get_colors(url)
+        except (HTTPError, URLError) as error:
+            self.media_player_callbacks.pop(entity, None)
+            self.metrics.increment("fetch_errors")
+            self.error("Unable to fetch artwork: {error}\nURL: {url}\n".format(url=url, error=error))
+            return
+        if self.is_superseded(entity, job):
+            return
+
+        if self.use_saturated_colors:
+            rgb_colors = [self.get_saturated_color(color) if len(color) == 3 else color for color in rgb_colors]
+        if self.color_assignment == "nearest":
+            rgb_colors = self.assign_colors(rgb_colors)  # against the colors the lights show, saturated or not
+        colors = {}
+        for i in range(len(self.lights)):
+            color = rgb_colors[i]
+            if color == [0, 0, 0] or len(color) == 0:
+                self.log("Skipped black color for '{entity}' light".format(entity=self.lights[i]))
+                continue
+            colors[self.lights[i]] = color
+        if self.interpolator is not None:
+            self.interpolator.start(colors, self.brightness)
+        else:
+            self.set_lights([dict(new_state="on", entity=entity, color=color, brightness=self.brightness, transition=self.transition)
+                             for entity, color in colors.items()])
+        if received_at is not None:
+            self.metrics.record("end_to_end", time.monotonic() - received_at)
+        self.publish_metrics()
+
+    def get_light_weights(self, weights):
+        """Light weights normalized to a maximum of 1, equal if unset or invalid."""
+        if weights is None:
+            return [1] * len(self.lights)
+        if len(weights) != len(self.lights) or not all(isinstance(weight, (int, float)) and weight > 0 for weight in weights):
+            self.log("light_weights must have one positive number per light, using equal weights.")
+            return [1] * len(self.lights)
+        return [weight / max(weights) for weight in weights]
+
+    def assign_colors(self, rgb_colors):
+        """Reorder the palette so that each light moves as little as possible from its current color.
+
+        Palette colors are ordered by prominence: lights with a higher weight are favored for the first colors.
+        """
+        labs = [rgb_to_lab(color) if len(color) == 3 else None for color in rgb_colors]
+        costs = []
+        for i, entity in enumerate(self.lights):
+            current_color = self.get_applied_color(entity)
+            current = rgb_to_lab(current_color) if current_color is not None else None
+            costs.append([
+                (ciede2000(current, lab) if current is not None and lab is not None else 0)
+                + PROMINENCE_COST * self.light_weights[i] * j / len(rgb_colors)
+                + 1e-6 * abs(i - j)  # keep the palette order on ties
+                for j, lab in enumerate(labs)])
+        return [rgb_colors[j] for j in min_cost_assignment(costs)]
+
+    def start_metrics(self, config):
+        """Create the metrics recorder, and register the Prometheus route (named after the app) if enabled."""
+        if not config:
+            return NullMetrics(), None
+        config = config if isinstance(config, dict) else {}
+        if config.get("prometheus", False):
+            self.register_route(self.metrics_route)
+        # One sensor per app by default, as every room usually has its own app
+        app_name = re.sub(r"[^a-z0-9_]", "_", (getattr(self, "name", None) or "media_lights_sync").lower())
+        return Metrics(config.get("window", 100)), config.get("sensor", "sensor.{name}_metrics".format(name=app_name))
+
+    def publish_metrics(self):
+        """Publish the end-to-end p50 latency and every metric as a Home Assistant sensor."""
+        if self.metrics_sensor is None:
+            return
+        end_to_end = self.metrics.percentiles("end_to_end")
+        attributes = dict(self.metrics.attributes(), unit_of_measurement="ms", friendly_name="Media Lights Sync latency")
+        self.set_state(self.metrics_sensor, state=round(end_to_end[0] * 1000) if end_to_end else "unknown", attributes=attributes)
+
+    async def metrics_route(self, request, kwargs):
+        from aiohttp import web  # provided by AppDaemon
+        return web.Response(text=self.metrics.prometheus(), content_type="text/plain")
+
+    def start_workers(self, threads):
+        """Start the pool fetching and quantizing artworks off the AppDaemon callback threads."""
+        self.pending_jobs = 0
+        self.queued_jobs = {}  # entity -> future of its latest artwork job
+        self.queued_prefetches = set()
+        self.jobs_lock = Lock()
+        self.prefetcher = None
+        if threads <= 0:
+            if self.prefetch_attributes:
+                self.prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="media_lights_sync_prefetch")
+            return None
+        self.log("Processing artworks with {threads} worker thread(s)".format(threads=threads))
+        return ThreadPoolExecutor(max_workers=threads, thread_name_prefix="media_lights_sync")
+
+    def submit_job(self, function, *args):
+        """Run function on the worker pool, or inline if worker_threads is not set."""
+        if self.workers is None:
+            return function(*args)
+
+        with self.jobs_lock:
+            if self.pending_jobs >= self.worker_queue_size:
+                self.metrics.increment("dropped_jobs")
+                self.log("Worker queue is full ({size} jobs), dropping artwork job".format(size=self.pending_jobs))
+                return None
+            self.pending_jobs += 1
+        future = self.workers.submit(function, *args)
+        future.add_done_callback(self.job_done)
+        return future
+
+    def job_done(self, future):
+        with self.jobs_lock:
+            self.pending_jobs -= 1
+        if not future.cancelled() and future.exception() is not None:
+            self.error("Unable to process artwork: {error}".format(error=future.exception()))
+
+    def listen_condition_entities(self):
+        """Listen to the entities the condition depends on to invalidate its cached result. Return False if it cannot be cached."""
+        if self.condition is None:
+            return False
+        if "value_template" in self.condition:
+            template = self.condition["value_template"]
+            entities = set(TEMPLATE_ENTITY_PATTERN.findall(re.sub(r"\bstates\.", "", template)))
+            if not entities or UNCACHEABLE_TEMPLATE_PATTERN.search(template):
+                self.log("The condition template is rendered for every picture, as its entities cannot be listened to")
+                return False
+        else:
+            entities = {self.condition["entity"]}
+        for entity in sorted(entities):
+            self.listen_state(self.invalidate_condition, entity, attribute="all")
+        return True
+
+    def invalidate_condition(self, entity, attribute, old, new, kwargs):
+        """Callback when an entity of the condition changed."""
+        with self.condition_lock:
+            self.condition_result = None
+            self.condition_version += 1
+
     def can_change_colors(self):
         """Validate that light should be sync if a condition is set."""
         if self.condition is None:
             return True
-        elif "value_template" in self.condition:
-            return self.render_template(self.condition["value_template"]) == True
+        if self.condition_result is not None:
+            return self.condition_result
+        version = self.condition_version
+        if "value_template" in self.condition:
+            result = self.render_template(self.condition["value_template"]) == True
         else:
-            return self.get_state(self.condition["entity"]) == self.condition["state"]
+            result = self.get_state(self.condition["entity"]) == self.condition["state"]
+        with self.condition_lock:
+            if self.condition_cacheable and version == self.condition_version:
+                self.condition_result = result
+        return result
 
     def store_initial_lights_states(self):
         """Save the initial state of all lights if not already done."""
         if self.reset_lights_after and self.initial_lights_states is None:
-            self.initial_lights_states = [self.get_state(self.lights[i], attribute="all") for i in range(len(self.lights))]
+            self.initial_lights_states = [self.get_state(light, attribute="all") for light in self.lights]
 
     def reset_lights(self):
         """Reset lights to their initial state after turning off a medial_player."""
         if self.reset_lights_after and self.initial_lights_states is not None:
             self.log("Resetting lights\n")
+            if self.interpolator is not None:
+                self.interpolator.cancel()
+            states = []
             for i in range(len(self.lights)):
                 state = self.initial_lights_states[i]["state"]
                 attributes = self.initial_lights_states[i]["attributes"]
-                color_attr = COLOR_MODES.get(attributes.get("color_mode", None), "rgb_color")
+                color_attr, color = self.get_stored_color(attributes)
 
-                self.set_light(state.lower(), self.lights[i], color=attributes.get(color_attr, None), color_attr=color_attr,
-                               brightness=attributes.get("brightness", None), transition=self.transition)
+                states.append(dict(new_state=state.lower(), entity=self.lights[i], color=color, color_attr=color_attr,
+                                   brightness=attributes.get("brightness", None), transition=self.transition))
+            self.set_lights(states)
             self.initial_lights_states = None
             self.media_player_callbacks = {}
 
+    def get_stored_color(self, attributes):
+        """Color attribute and value restoring a stored light state. Other color modes are restored from rgb_color."""
+        color_attr = COLOR_MODES.get(attributes.get("color_mode", None), "rgb_color")
+        color = attributes.get(color_attr, None)
+        if color_attr == "color_temp_kelvin" and color is None and attributes.get("color_temp", None):
+            color = round(1000000 / attributes["color_temp"])  # mireds reported by older Home Assistant versions
+        return color_attr, color
+
     def set_light(self, new_state, entity, color=None, color_attr="rgb_color", brightness=None, transition=None):
         """Change the color of a light."""
+        self.set_lights([dict(new_state=new_state, entity=entity, color=color, color_attr=color_attr, brightness=brightness, transition=transition)])
+
+    def set_lights(self, states):
+        """Change several lights at once, each state being the set_light arguments of a light."""
+        commands = [self.light_command(**state) for state in states]
+        self.dispatcher.send_many([command for command in commands if command is not None])
+
+    def light_command(self, new_state, entity, color=None, color_attr="rgb_color", brightness=None, transition=None):
+        """Build the (entity, service, attributes) command of a light state, or None if the light already shows it."""
         attributes = {}
         if transition is not None:
             attributes["transition"] = transition
 
+        if self.is_redundant(entity, new_state, color, color_attr, brightness, transition):
+            self.suppressed_commands += 1
+            self.metrics.increment("suppressed_commands")
+            self.log("Skipped unchanged '{entity}' light ({count} suppressed)".format(entity=entity, count=self.suppressed_commands))
+            return None
+        self.last_applied_states[entity] = (new_state, color, color_attr, brightness, transition)
+
         if new_state == "off":
             self.log("Turn off '{entity}' light".format(entity=entity))
-            Thread(target=self.turn_off, args=[entity], kwargs=attributes).start()
-        else:
-            attributes[color_attr] = color
-            if brightness is not None:
-                attributes["brightness"] = brightness
-            self.log("Set '{entity}' light:\n{attributes}".format(entity=entity, attributes=attributes))
-            Thread(target=self.turn_on, args=[entity], kwargs=attributes).start()
+            return entity, "turn_off", attributes
+        attributes.update(self.encode_color(entity, color, color_attr))
+        if brightness is not None:
+            attributes["brightness"] = brightness
+        self.log("Set '{entity}' light:\n{attributes}".format(entity=entity, attributes=attributes))
+        return entity, "turn_on", attributes
+
+    def load_light_capabilities(self):
+        """Read the supported color modes of every light, and refresh them when they change."""
+        capabilities = {}
+        for light in self.lights:
+            capabilities[light] = self.get_light_capabilities(self.get_state(light, attribute="all"))
+            self.listen_state(self.update_light_capabilities, light, attribute="supported_color_modes")
+        return capabilities
+
+    def update_light_capabilities(self, entity, attribute, old, new, kwargs):
+        """Callback when the supported color modes of a light changed."""
+        self.light_capabilities[entity] = self.get_light_capabilities(self.get_state(entity, attribute="all"))
+        self.log("Updated '{entity}' light capabilities: {capabilities}".format(entity=entity, capabilities=self.light_capabilities[entity]))
+
+    def get_light_capabilities(self, state):
+        """Native color mode and color temperature range of a light, or None if it does not report its color modes."""
+        attributes = (state or {}).get("attributes", {})
+        modes = attributes.get("supported_color_modes", None)
+        if not modes:
+            return None
+        return {
+            "mode": next((mode for mode in NATIVE_COLOR_MODES if mode in modes), None),
+            "min_kelvin": attributes.get("min_color_temp_kelvin", None) or 2000,
+            "max_kelvin": attributes.get("max_color_temp_kelvin", None) or 6500,
+        }
+
+    def encode_color(self, entity, color, color_attr="rgb_color"):
+        """Encode an RGB color in the native color mode of the light: rgb, rgbww, rgbw, xy, hs or the nearest color temperature."""
+        capabilities = self.light_capabilities.get(entity, None)
+        if color is None:
+            return {}
+        if color_attr != "rgb_color" or capabilities is None:
+            return {color_attr: color}
+        mode = capabilities["mode"]
+        if mode == "rgb":
+            return {"rgb_color": color}
+        if mode in ["rgbw", "rgbww"]:
+            white = min(color)
+            whites = [white] if mode == "rgbw" else [white // 2, white - white // 2]  # cold and warm white
+            return {mode + "_color": [c - white for c in color] + whites}
+        if mode == "xy":
+            return {"xy_color": rgb_to_xy(color)}
+        if mode == "hs":
+            hue, saturation, _value = colorsys.rgb_to_hsv(color[0] / 255, color[1] / 255, color[2] / 255)
+            return {"hs_color": [round(hue * 360, 2), round(saturation * 100, 2)]}
+        if mode == "color_temp":
+            return {"color_temp_kelvin": nearest_kelvin(rgb_to_xy(color), capabilities["min_kelvin"], capabilities["max_kelvin"])}
+        return {}  # brightness or on/off only
+
+    def get_applied_color(self, entity):
+        """RGB color last sent to a light, or None if unknown."""
+        last_state = self.last_applied_states.get(entity, None)
+        if last_state is None or last_state[0] != "on" or last_state[2] != "rgb_color" or not last_state[1]:
+            return None
+        return last_state[1]
+
+    def light_changed(self, entity, attribute, old, new, kwargs):
+        """Callback when a light changed: forget its last applied state if the light was changed outside of the app."""
+        last_state = self.last_applied_states.get(entity, None)
+        if last_state is None or new is None or self.shows_applied_state(new, last_state):
+            return
+        self.last_applied_states.pop(entity, None)
+        self.log("'{entity}' light was changed outside of the app".format(entity=entity))
+
+    def shows_applied_state(self, state, last_state):
+        """Check if a light state reported by Home Assistant is the echo of the last applied state."""
+        new_state, color, color_attr, brightness, _transition = last_state
+        if state.get("state", None) != new_state:
+            return False
+        if new_state == "off":
+            return True
+        attributes = state.get("attributes", {})
+        if brightness is not None and attributes.get("brightness", None) not in [None, brightness]:
+            return False
+        reported = attributes.get(color_attr, None)
+        if color is None or reported is None:
+            return True
+        if color_attr != "rgb_color":
+            return reported == color
+        # Home Assistant reports the color at full value and moves lightness to brightness: compare hue and saturation only
+        return ciede2000(rgb_to_lab(full_value_rgb(color)), rgb_to_lab(full_value_rgb(reported))) <= max(self.color_delta_threshold or 0, ECHO_COLOR_TOLERANCE)
+
+    def is_redundant(self, entity, new_state, color, color_attr, brightness, transition):
+        """Check if the light already shows a perceptually identical state."""
+        last_state = self.last_applied_states.get(entity, None)
+        if self.color_delta_threshold is None or last_state is None:
+            return False
+        last_new_state, last_color, last_color_attr, last_brightness, last_transition = last_state
+        if (new_state, color_attr, brightness, transition) != (last_new_state, last_color_attr, last_brightness, last_transition):
+            return False
+        if new_state == "off" or color == last_color:
+            return True
+        if color_attr != "rgb_color" or color is None or last_color is None:
+            return False
+        return ciede2000(rgb_to_lab(color), rgb_to_lab(last_color)) <= self.color_delta_threshold
 
     def get_saturated_color(self, color):
         """Increase the saturation of the current color."""
@@ -127,17 +1602,127 @@ class MediaLightsSync(hass.Hass):
         rgb_saturated = colorsys.hls_to_rgb(hls[0], 0.5, 0.5)
         return [int(rgb_saturated[0] * 255), int(rgb_saturated[1] * 255), int(rgb_saturated[2] * 255)]
 
+    def terminate(self):
+        """Release the worker pool and palette store when AppDaemon stops or reloads the app."""
+        if self.workers is not None:
+            self.workers.shutdown(wait=False, cancel_futures=True)
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown(wait=False, cancel_futures=True)
+        self.dispatcher.stop()
+        if self.ambilight is not None:
+            self.ambilight.stop()
+        if self.interpolator is not None:
+            self.interpolator.stop()
+        self.fetcher.close()
+        if self.palette_store is not None:
+            self.palette_store.close()
+        SHARED_PIPELINE.unregister(id(self))
+
+    def open_palette_store(self, path, size, method):
+        """Open the persistent palette store and warm up the palette cache from it."""
+        if not path:
+            return None
+        if path is True:
+            path = os.path.join(self.config_dir, "media_lights_sync.db")
+        store = PaletteStore(path, size, method or "default")
+        for url, digest, colors in store.recent(self.palette_light_count(), self.palette_cache.size):
+            self.palette_cache.put(url, digest, colors)
+        self.log("Using palette store '{path}'".format(path=path))
+        return store
+
+    def extraction_settings(self):
+        """Settings that must match for two apps to share their artwork processing."""
+        return (self.args.get("quantization_method", None), self.max_image_size, self.resample_filter)
+
+    def palette_light_count(self):
+        """Number of colors extracted from each artwork."""
+        if self.share_artwork:
+            return max(SHARED_PIPELINE.light_count(self.extraction_settings()), len(self.lights))
+        return len(self.lights)
+
     def get_colors(self, url):
-        """Get the palette of colors from url."""
-        context = ssl.SSLContext() if not self.verify_cert else None
-        fd = urlopen(url, context=context)
-        f = io.BytesIO(fd.read())
-        im = Image.open(f)
-        if im.mode == "RGBA" and self.quantization_method not in [None, Image.FASTOCTREE, Image.LIBIMAGEQUANT]:
-            im = self.convert_rgba_to_rgb(im)
+        """Get one color per light from the artwork at url."""
+        count = self.palette_light_count()
+        if self.share_artwork:
+            colors = SHARED_PIPELINE.get_colors(self.extraction_settings(), url, lambda: self.get_palette(url, count))
+        elif self.prefetch_attributes:
+            # An artwork still being prefetched is awaited rather than processed twice
+            colors = SHARED_PIPELINE.get_colors(id(self), url, lambda: self.get_palette(url, count))
+        else:
+            colors = self.get_palette(url, count)
+        return colors[:len(self.lights)]
+
+    def get_palette(self, url, count):
+        """Get count colors from url, using the palette cache and store when enabled."""
+        if self.palette_cache.size <= 0 and self.palette_store is None:
+            return self.extract_image_colors(self.fetch_image(url)[0], count)
+
+        colors = self.get_cached_colors(count, url=url)
+        if colors is None:
+            data, digest = self.fetch_image(url, is_cached=lambda digest: self.get_cached_colors(count, digest=digest) is not None)
+            colors = self.get_cached_colors(count, digest=digest)
+            if colors is None and data is None:
+                # Not modified, but the palette has since been evicted
+                data, digest = self.fetch_image(url)
+            self.palette_cache.record(hit=colors is not None)
+            self.metrics.increment("palette_cache_hits" if colors is not None else "palette_cache_misses")
+            if colors is None:
+                colors = self.extract_image_colors(data, count)
+            self.cache_colors(count, url, digest, colors)
+        else:
+            self.palette_cache.record(hit=True)
+            self.metrics.increment("palette_cache_hits")
+        self.log("Palette cache {stats}".format(stats=self.palette_cache.stats()))
+        return colors
+
+    def get_cached_colors(self, count, url=None, digest=None):
+        """Look up count colors in the palette cache, then in the palette store."""
+        colors = self.palette_cache.get(url=url, digest=digest)
+        if colors is not None and len(colors) != count:
+            colors = None  # extracted for another light count
+        if colors is None and self.palette_store is not None:
+            stored = self.palette_store.get(count, url=url, digest=digest)
+            if stored is not None:
+                digest, colors = stored
+                self.palette_cache.put(url, digest, colors)  # by digest only when looked up by digest
+        return colors
 
-        palette = im.quantize(colors=len(self.lights), method=self.quantization_method).getpalette()
-        return self.extract_colors(palette, len(self.lights))
+    def cache_colors(self, count, url, digest, colors):
+        self.palette_cache.put(url, digest, colors)
+        if self.palette_store is not None:
+            self.palette_store.put(count, url, digest, colors)
+
+    def fetch_image(self, url, is_cached=None):
+        """Download the raw artwork (bytes, digest) from url. bytes is None if the artwork was not modified."""
+        with self.metrics.timer("fetch"):
+            return self.fetcher.fetch(url, is_cached)
+
+    def extract_image_colors(self, data, count=None):
+        """Quantize the artwork bytes into count colors, one per light by default."""
+        count = count or len(self.lights)
+        with self.metrics.timer("decode"):
+            im = self.downscale_image(Image.open(io.BytesIO(data)))
+            im.load()
+        with self.metrics.timer("quantize"):
+            if self.quantization_method == KMEANS:
+                return kmeans_colors(im, count)
+            if self.quantization_method == HISTOGRAM:
+                return histogram_colors(im, count)
+            if im.mode == "RGBA" and self.quantization_method not in [None, Image.FASTOCTREE, Image.LIBIMAGEQUANT]:
+                im = self.convert_rgba_to_rgb(im)
+
+            quantized = im.quantize(colors=count, method=self.quantization_method)
+            return self.extract_colors(self.sort_palette(quantized), count)
+
+    def downscale_image(self, image):
+        """Shrink the image so that its largest edge fits in max_image_size before quantization."""
+        if self.max_image_size is None:
+            return image
+        size = (self.max_image_size, self.max_image_size)
+        if image.format == "JPEG":
+            image.draft(image.mode, size)  # let the JPEG decoder skip the full resolution DCT
+        image.thumbnail(size, resample=self.resample_filter)
+        return image
 
     def convert_rgba_to_rgb(self, rgba_image):
         rgba_image.load()  # required for png.split()
@@ -158,9 +1743,29 @@ class MediaLightsSync(hass.Hass):
                 method = Image.LIBIMAGEQUANT
             else:
                 self.log("Quantization method 'libimagequant' is unsupported by your platform.")
+        elif value in [KMEANS, HISTOGRAM]:
+            if np is not None:
+                method = value
+            else:
+                self.log("Quantization method '{value}' requires numpy to be installed.".format(value=value))
         self.log("Using {method} quantization method".format(method="default" if method is None else value))
         return method
 
+    def get_resample_filter(self, value):
+        if value is None:
+            return Image.BOX
+        if value not in RESAMPLE_FILTERS:
+            self.log("Resample filter '{value}' is unsupported, using 'box'.".format(value=value))
+            return Image.BOX
+        return RESAMPLE_FILTERS[value]
+
+    def sort_palette(self, quantized):
+        """Reorder the palette of a quantized image so that its most used entries come first."""
+        palette = quantized.getpalette()
+        used = [index for _, index in sorted(quantized.getcolors(), key=lambda entry: -entry[0])]
+        order = used + [index for index in range(len(palette) // 3) if index not in used]
+        return [value for index in order for value in palette[index * 3:index * 3 + 3]]
+
     def extract_colors(self, palette, colors):
         """Extract an amount of colors corresponding to the amount of lights in the configuration."""
         return [palette[i:i + 3] for i in range(0, colors * 3, 3)]
@@ -0,0 +1,205 @@
+"""Benchmark the color extraction pipeline of MediaLightsSync outside of AppDaemon.
+
+Runs get_colors, extract_colors and get_saturated_color on a corpus of local artworks for every
+quantization_method and light count, and reports throughput, p50/max latency and peak RSS. With the default
+number of runs, a p99 would only be the slowest run, so the maximum is reported as such.
+
+Usage:
+    python benchmarks/benchmark.py                                 # run the whole suite
+    python benchmarks/benchmark.py --save-baseline baseline.json   # store the results as a baseline
+    python benchmarks/benchmark.py --baseline baseline.json        # fail if p50 latencies regressed
+    python benchmarks/benchmark.py --downscale-report              # compare downscaled and full size palettes
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from apps.media_lights_sync.media_lights_sync import MediaLightsSync  # noqa: E402
+from PIL import Image  # noqa: E402
+
+EXAMPLES_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "examples"))
+EXAMPLE_IMAGE = os.path.join(EXAMPLES_DIR, "example-1.jpg")
+QUANTIZATION_METHODS = ["default", "FastOctree", "MedianCut", "MaxCoverage", "libimagequant", "KMeans", "Histogram"]
+IMAGE_FORMATS = {
+    # name: (mode, file extension)
+    "jpeg": ("RGB", "jpg"),
+    "png": ("RGB", "png"),
+    "rgba": ("RGBA", "png"),
+    "palette": ("P", "png"),
+    "grayscale": ("L", "jpg"),
+}
+
+
+class BenchmarkApp(MediaLightsSync):
+    """MediaLightsSync running without AppDaemon, with the given args."""
+
+    def __init__(self, args):
+        self.args = args
+
+    def log(self, msg, *args, **kwargs):
+        pass
+
+    def listen_state(self, *args, **kwargs):
+        pass
+
+    def get_state(self, *args, **kwargs):
+        return {}
+
+
+def create_app(method, lights, max_image_size=None):
+    args = {"media_player": "media_player.benchmark",
+            "lights": ["light.benchmark_{i}".format(i=i) for i in range(lights)],
+            "quantization_method": None if method == "default" else method,
+            "max_image_size": max_image_size}
+    app = BenchmarkApp(args)
+    app.initialize()
+    return app
+
+
+def create_corpus(directory, sizes):
+    """Write the example artwork in every IMAGE_FORMATS and size, and return {name: file url}."""
+    corpus = {}
+    source = Image.open(EXAMPLE_IMAGE)
+    for size in sizes:
+        image = source.resize((size, size * source.height // source.width))
+        for name, (mode, extension) in IMAGE_FORMATS.items():
+            if mode == "RGBA":
+                converted = image.convert("RGBA")
+                converted.putalpha(200)
+            elif mode == "P":
+                converted = image.convert("P", palette=Image.ADAPTIVE)
+            else:
+                converted = image.convert(mode)
+            path = os.path.join(directory, "{name}_{size}.{extension}".format(name=name, size=size, extension=extension))
+            converted.save(path)
+            corpus["{name}_{size}".format(name=name, size=size)] = "file://" + path
+    return corpus
+
+
+def load_corpus(directory):
+    return {os.path.splitext(file)[0]: "file://" + os.path.abspath(os.path.join(directory, file))
+            for file in sorted(os.listdir(directory))}
+
+
+def run_case(case):
+    """Benchmark one method and light count on every image. Runs in a fresh process to measure its peak RSS."""
+    method, lights, corpus, runs, max_image_size = case
+    app = create_app(method, lights, max_image_size)
+    if app.get_quantization_method(None if method == "default" else method) is None and method != "default":
+        return None  # unsupported on this platform
+
+    results = {}
+    for image, url in corpus.items():
+        latencies = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            colors = app.get_colors(url)
+            [app.get_saturated_color(color) for color in colors if len(color) == 3]
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        results[image] = {
+            "p50_ms": latencies[len(latencies) // 2] * 1000,
+            "max_ms": latencies[-1] * 1000,
+            "throughput": runs / sum(latencies),
+        }
+    app.dispatcher.stop()
+    return {"results": results, "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def run_suite(methods, lights_counts, corpus, runs, max_image_size):
+    """Return {"method/lights/image": metrics} for every case."""
+    report = {}
+    for method in methods:
+        for lights in lights_counts:
+            with multiprocessing.Pool(1) as pool:
+                case = pool.apply(run_case, ((method, lights, corpus, runs, max_image_size),))
+            if case is None:
+                print("{method}: unsupported, skipped".format(method=method))
+                continue
+            for image, metrics in case["results"].items():
+                key = "{method}/{lights}/{image}".format(method=method, lights=lights, image=image)
+                report[key] = dict(metrics, peak_rss_mb=case["peak_rss_mb"])
+                print("{key:<40} {throughput:8.1f} img/s  p50 {p50_ms:8.1f} ms  max {max_ms:8.1f} ms  peak RSS {peak_rss_mb:6.1f} MB".format(
+                    key=key, **report[key]))
+    return report
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    """Return the cases whose p50 latency regressed by more than tolerance compared to the baseline."""
+    regressions = []
+    for key, metrics in report.items():
+        if key in baseline and metrics["p50_ms"] > baseline[key]["p50_ms"] * (1 + tolerance):
+            regressions.append("{key}: p50 {p50:.1f} ms, baseline {baseline:.1f} ms".format(
+                key=key, p50=metrics["p50_ms"], baseline=baseline[key]["p50_ms"]))
+    return regressions
+
+
+def downscale_report(max_image_size, methods, runs):
+    """Compare the latency and palette of 4K artworks with and without max_image_size."""
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = {name: url for name, url in create_corpus(directory, [3840]).items() if name.startswith(("jpeg", "rgba"))}
+        for method in methods:
+            full_size, downscaled = create_app(method, 2), create_app(method, 2, max_image_size)
+            for name, url in corpus.items():
+                start = time.perf_counter()
+                for _ in range(runs):
+                    reference = full_size.get_colors(url)
+                reference_ms = (time.perf_counter() - start) / runs * 1000
+                start = time.perf_counter()
+                for _ in range(runs):
+                    colors = downscaled.get_colors(url)
+                downscaled_ms = (time.perf_counter() - start) / runs * 1000
+                distance = max(abs(a - b) for color, ref in zip(colors, reference) for a, b in zip(color, ref))
+                print("{method}/{name}: full size {reference_ms:.1f} ms, downscaled {downscaled_ms:.1f} ms ({speedup:.1f}x), "
+                      "max channel difference {distance}".format(
+                          method=method, name=name, reference_ms=reference_ms, downscaled_ms=downscaled_ms,
+                          speedup=reference_ms / downscaled_ms, distance=distance))
+            full_size.dispatcher.stop()
+            downscaled.dispatcher.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--methods", nargs="+", default=QUANTIZATION_METHODS, choices=QUANTIZATION_METHODS)
+    parser.add_argument("--lights", nargs="+", type=int, default=[1, 2, 5])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[300, 1000, 3840], help="widths of the generated corpus")
+    parser.add_argument("--corpus", help="directory of images to use instead of the generated corpus")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-image-size", type=int, default=None)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--save-baseline", help="write the results to this baseline JSON file")
+    parser.add_argument("--baseline", help="fail if p50 latencies regressed compared to this baseline JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 regression ratio (default: 0.25)")
+    parser.add_argument("--downscale-report", action="store_true", help="compare downscaled and full size 4K artworks")
+    options = parser.parse_args()
+
+    if options.downscale_report:
+        return downscale_report(options.max_image_size or 256, options.methods, options.runs)
+
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = load_corpus(options.corpus) if options.corpus else create_corpus(directory, options.sizes)
+        report = run_suite(options.methods, options.lights, corpus, options.runs, options.max_image_size)
+
+    for path in [options.output, options.save_baseline]:
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), options.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+        print("No regression compared to {baseline}".format(baseline=options.baseline))
+
+
+if __name__ == "__main__":
+    main()
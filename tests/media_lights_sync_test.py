@@ -1,11 +1,22 @@
 import pytest
 import logging
 import contextlib
+import io
+import json
 import os
+import time
 
 from appdaemontestframework import automation_fixture
-from apps.media_lights_sync.media_lights_sync import MediaLightsSync, PICTURE_ATTRIBUTES
+from benchmarks.benchmark import QUANTIZATION_METHODS, compare_to_baseline
+from apps.media_lights_sync.media_lights_sync import (
+    AmbilightLoop, LightDispatcher, MediaLightsSync, Metrics, NullMetrics, PaletteCache, PaletteStore, PICTURE_ATTRIBUTES, SHARED_PIPELINE,
+    SharedArtworkPipeline, ciede2000, color_histogram, histogram_colors, kmeans_colors, lab_to_rgb, min_cost_assignment,
+    nearest_kelvin, rgb_to_lab, rgb_to_xy)
 from PIL import Image
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread, current_thread
+from unittest import mock
+from urllib.error import HTTPError, URLError
 
 test_light_1_base_state = {'brightness': 50, 'rgb_color': [123, 123, 123]}
 
@@ -78,6 +89,7 @@ def media_player(media_lights_sync, given_that):
                 old_url = None
                 new_url = attributes[current_attribute]
             media_lights_sync.change_lights_color(self.entity, current_attribute, old_url, new_url, None)
+            media_lights_sync.dispatcher.wait_idle()
 
     return UpdateState
 
@@ -104,7 +116,7 @@ class TestCallbacks:
 
 
 class TestExtractImageColors:
-    quantization_methods = [None, "FastOctree", "MedianCut", "MaxCoverage", "libimagequant"]
+    quantization_methods = [None, "FastOctree", "MedianCut", "MaxCoverage", "libimagequant", "KMeans"]
 
     def assert_two_colors(self, colors):
         assert len(colors) == 2
@@ -142,6 +154,1061 @@ class TestExtractImageColors:
 
             self.assert_two_colors(colors)
 
+    def test_palette_is_sorted_by_pixel_count(self, media_lights_sync):
+        image = Image.new("RGB", (10, 10), (255, 0, 0))
+        image.paste((0, 0, 255), (0, 0, 10, 9))
+        data = io.BytesIO()
+        image.save(data, "PNG")
+
+        assert image.quantize(colors=2).getpalette()[:3] == [255, 0, 0]
+        assert media_lights_sync.extract_image_colors(data.getvalue()) == [[0, 0, 255], [255, 0, 0]]
+
+
+class TestKMeans:
+    @pytest.fixture
+    def kmeans_media_lights_sync(self, media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('quantization_method').is_set_to('KMeans')
+        return media_lights_sync
+
+    def test_distinct_colors_sorted_by_weight(self, kmeans_media_lights_sync):
+        image = Image.new("RGB", (100, 100), (200, 30, 30))
+        image.paste((30, 30, 200), (0, 0, 100, 20))
+
+        assert kmeans_colors(image, 2) == [[200, 30, 30], [30, 30, 200]]
+
+    def test_large_images_are_sampled_before_conversion(self):
+        image = Image.new("RGB", (1000, 1000), (200, 30, 30))
+        image.paste((30, 30, 200), (0, 0, 1000, 200))
+
+        with mock.patch.object(Image.Image, 'convert', autospec=True, side_effect=Image.Image.convert) as convert:
+            assert kmeans_colors(image, 2) == [[200, 30, 30], [30, 30, 200]]
+        assert convert.call_args[0][0].width * convert.call_args[0][0].height <= 16384
+
+    def test_ignore_near_white_and_transparent_pixels(self, kmeans_media_lights_sync):
+        colors = kmeans_media_lights_sync.get_colors(color_images['red_and_white'])
+        image = Image.new("RGBA", (10, 10), (0, 255, 0, 0))
+        image.paste((0, 0, 255, 255), (0, 0, 10, 2))
+
+        assert colors == [[255, 0, 0], [0, 0, 0]]
+        assert kmeans_colors(image, 1) == [[0, 0, 255]]
+
+    def test_skip_if_image_is_all_black(self, kmeans_media_lights_sync, media_player, assert_that):
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": color_images['black']})
+
+        assert_that('light.test_light_1').was_not.turned_on()
+        assert_that('light.test_light_2').was_not.turned_on()
+
+    def test_numpy_is_required(self, media_lights_sync, update_passed_args, given_that, hass_logs):
+        with mock.patch('apps.media_lights_sync.media_lights_sync.np', None):
+            with update_passed_args():
+                given_that.passed_arg('quantization_method').is_set_to('KMeans')
+
+        assert any("'KMeans' requires numpy" in log for log in hass_logs())
+        assert media_lights_sync.quantization_method is None
+
+
+class TestHistogram:
+    @pytest.fixture
+    def histogram_media_lights_sync(self, media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('quantization_method').is_set_to('Histogram')
+        return media_lights_sync
+
+    def test_distinct_colors_sorted_by_weight(self):
+        image = Image.new("RGB", (100, 100), (200, 30, 30))
+        image.paste((30, 30, 200), (0, 0, 100, 20))
+
+        assert histogram_colors(image, 2) == [[200, 30, 30], [30, 30, 200]]
+
+    def test_counts_are_alpha_weighted(self):
+        image = Image.new("RGBA", (10, 10), (0, 255, 0, 0))
+        image.paste((0, 0, 255, 255), (0, 0, 10, 2))
+        image.paste((255, 0, 0, 51), (0, 2, 10, 4))
+
+        colors, counts = color_histogram(image)
+        assert colors.round().tolist() == [[0, 0, 255], [255, 0, 0]]
+        assert counts.round(6).tolist() == [20, 4]
+
+    def test_strips_give_the_same_histogram(self):
+        image = Image.open(image_path("../../examples/example-1.jpg"))
+        colors, counts = color_histogram(image)
+
+        with mock.patch('apps.media_lights_sync.media_lights_sync.HISTOGRAM_STRIP_PIXELS', image.width * 7):
+            strip_colors, strip_counts = color_histogram(image)
+
+        assert counts.sum() == image.width * image.height
+        assert strip_counts.tolist() == counts.tolist()
+        assert strip_colors == pytest.approx(colors)
+
+    def test_can_extract_colors(self, histogram_media_lights_sync):
+        colors = histogram_media_lights_sync.get_colors(color_images['red_and_white'])
+
+        assert colors == [[255, 0, 0], [0, 0, 0]]
+        assert len(histogram_media_lights_sync.get_colors(rgba_images['nyanCat'])) == 2
+
+    def test_numpy_is_required(self, media_lights_sync, update_passed_args, given_that, hass_logs):
+        with mock.patch('apps.media_lights_sync.media_lights_sync.np', None):
+            with update_passed_args():
+                given_that.passed_arg('quantization_method').is_set_to('Histogram')
+
+        assert any("'Histogram' requires numpy" in log for log in hass_logs())
+        assert media_lights_sync.quantization_method is None
+
+
+class TestDownscaling:
+    def test_no_downscaling_by_default(self, media_lights_sync):
+        image = Image.new("RGB", (1000, 800))
+
+        assert media_lights_sync.downscale_image(image).size == (1000, 800)
+
+    def test_downscale_to_max_image_size(self, media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('max_image_size').is_set_to(100)
+
+        assert media_lights_sync.downscale_image(Image.new("RGBA", (1000, 800))).size == (100, 80)
+        assert media_lights_sync.downscale_image(Image.new("RGB", (50, 40))).size == (50, 40)
+
+    def test_downscaled_palette_is_nearly_unchanged(self, media_lights_sync, update_passed_args, given_that):
+        colors = media_lights_sync.get_colors(rgb_images[0])
+        with update_passed_args():
+            given_that.passed_arg('max_image_size').is_set_to(256)
+
+        downscaled_colors = media_lights_sync.get_colors(rgb_images[0])
+
+        for color, downscaled_color in zip(colors, downscaled_colors):
+            assert all(abs(a - b) <= 5 for a, b in zip(color, downscaled_color))
+
+    def test_downscale_rgba_image(self, media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('max_image_size').is_set_to(64)
+            given_that.passed_arg('quantization_method').is_set_to('MedianCut')
+
+        colors = media_lights_sync.get_colors(rgba_images["nyanCat"])
+
+        assert len(colors) == 2
+
+    def test_givin_wrong_resample_filter_use_box(self, media_lights_sync, update_passed_args, given_that, hass_logs):
+        with update_passed_args():
+            given_that.passed_arg('resample_filter').is_set_to('invalid')
+
+        assert any("Resample filter 'invalid' is unsupported" in log for log in hass_logs())
+        assert media_lights_sync.resample_filter == Image.BOX
+
+
+class TestPaletteCache:
+    @pytest.fixture
+    def cached_media_lights_sync(self, media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('palette_cache_size').is_set_to(2)
+        return media_lights_sync
+
+    def test_cache_is_disabled_by_default(self, media_lights_sync):
+        with mock.patch.object(media_lights_sync, 'fetch_image', wraps=media_lights_sync.fetch_image) as fetch_image:
+            media_lights_sync.get_colors(rgb_images[0])
+            media_lights_sync.get_colors(rgb_images[0])
+
+        assert fetch_image.call_count == 2
+
+    def test_same_url_skips_fetch(self, cached_media_lights_sync, hass_logs):
+        colors = cached_media_lights_sync.get_colors(rgb_images[0])
+        with mock.patch.object(cached_media_lights_sync, 'fetch_image') as fetch_image:
+            assert cached_media_lights_sync.get_colors(rgb_images[0]) == colors
+
+        fetch_image.assert_not_called()
+        assert "Palette cache hits: 1, misses: 1, size: 1/2" in hass_logs()[-1]
+
+    def test_same_content_under_new_url_skips_extraction(self, cached_media_lights_sync, tmp_path):
+        copied_image = tmp_path / "copy.jpg"
+        copied_image.write_bytes(open(image_path("../../examples/example-1.jpg"), "rb").read())
+        colors = cached_media_lights_sync.get_colors(rgb_images[0])
+        with mock.patch.object(cached_media_lights_sync, 'extract_image_colors') as extract_image_colors:
+            assert cached_media_lights_sync.get_colors("file://" + str(copied_image)) == colors
+
+        extract_image_colors.assert_not_called()
+
+    def test_least_recently_used_palette_is_evicted(self):
+        cache = PaletteCache(2)
+        cache.put("url_1", "digest_1", [[1, 1, 1]])
+        cache.put("url_2", "digest_2", [[2, 2, 2]])
+        cache.get(url="url_1")
+        cache.put("url_3", "digest_3", [[3, 3, 3]])
+
+        assert cache.get(url="url_1") == [[1, 1, 1]]
+        assert cache.get(url="url_2") is None
+        assert cache.get(digest="digest_3") == [[3, 3, 3]]
+
+    def test_palettes_looked_up_by_digest_are_not_cached_by_url(self, media_lights_sync, update_passed_args, given_that, tmp_path):
+        with update_passed_args():
+            given_that.passed_arg('palette_cache_size').is_set_to(2)
+            given_that.passed_arg('palette_store').is_set_to(str(tmp_path / "palettes.db"))
+        media_lights_sync.palette_store.put(2, "url_1", "digest_1", [[1, 1, 1], [2, 2, 2]])
+
+        assert media_lights_sync.get_cached_colors(2, digest="digest_1") == [[1, 1, 1], [2, 2, 2]]
+        assert list(media_lights_sync.palette_cache.urls) == []
+        assert media_lights_sync.palette_cache.get(digest="digest_1") == [[1, 1, 1], [2, 2, 2]]
+
+
+class TestPaletteStore:
+    @pytest.fixture
+    def store_path(self, tmp_path):
+        return str(tmp_path / "media_lights_sync.db")
+
+    def test_palettes_survive_restarts(self, media_lights_sync, update_passed_args, given_that, store_path):
+        with update_passed_args():
+            given_that.passed_arg('palette_store').is_set_to(store_path)
+        colors = media_lights_sync.get_colors(rgb_images[0])
+        media_lights_sync.terminate()
+
+        media_lights_sync.initialize()
+        with mock.patch.object(media_lights_sync, 'fetch_image') as fetch_image:
+            assert media_lights_sync.get_colors(rgb_images[0]) == colors
+
+        fetch_image.assert_not_called()
+
+    def test_warm_up_palette_cache(self, media_lights_sync, update_passed_args, given_that, store_path):
+        with update_passed_args():
+            given_that.passed_arg('palette_store').is_set_to(store_path)
+        colors = media_lights_sync.get_colors(rgb_images[0])
+        media_lights_sync.terminate()
+
+        with update_passed_args():
+            given_that.passed_arg('palette_cache_size').is_set_to(10)
+
+        assert media_lights_sync.palette_cache.get(url=rgb_images[0]) == colors
+
+    def test_palettes_are_keyed_by_light_count(self, store_path):
+        PaletteStore(store_path, 10, "default").put(2, "url", "digest", [[1, 1, 1], [2, 2, 2]])
+
+        assert PaletteStore(store_path, 10, "default").get(3, url="url") is None
+        assert PaletteStore(store_path, 10, "MedianCut").get(2, digest="digest") is None
+        assert PaletteStore(store_path, 10, "default").get(2, digest="digest") == ("digest", [[1, 1, 1], [2, 2, 2]])
+
+    def test_least_recently_used_palettes_are_evicted(self, store_path):
+        store = PaletteStore(store_path, 2, "default")
+        for i in range(3):
+            store.put(1, "url_{i}".format(i=i), "digest_{i}".format(i=i), [[i, i, i]])
+
+        assert store.get(1, url="url_0") is None
+        assert [url for url, _digest, _colors in store.recent(1, 10)] == ["url_1", "url_2"]
+
+
+class TestWorkers:
+    @pytest.fixture
+    def threaded_media_lights_sync(self, media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('worker_threads').is_set_to(1)
+            given_that.passed_arg('worker_queue_size').is_set_to(1)
+        return media_lights_sync
+
+    def test_colors_are_applied_by_workers(self, threaded_media_lights_sync, media_player, assert_that):
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+        threaded_media_lights_sync.workers.shutdown(wait=True)
+        threaded_media_lights_sync.dispatcher.wait_idle()
+
+        assert_that('light.test_light_1').was.turned_on(brightness=255, rgb_color=[59, 180, 180])
+        assert_that('light.test_light_2').was.turned_on(brightness=255, rgb_color=[46, 56, 110])
+
+    def test_jobs_are_dropped_when_queue_is_full(self, threaded_media_lights_sync, hass_logs):
+        release = Event()
+        running_job = threaded_media_lights_sync.submit_job(release.wait)
+
+        assert threaded_media_lights_sync.submit_job(release.wait) is None
+        assert any('Worker queue is full' in log for log in hass_logs())
+        release.set()
+        running_job.result()
+        threaded_media_lights_sync.workers.shutdown(wait=True)
+        assert threaded_media_lights_sync.pending_jobs == 0
+
+    def test_queued_job_is_replaced_when_queue_is_full(self, threaded_media_lights_sync, media_player, update_passed_args,
+                                                       given_that, assert_that, hass_mocks, hass_logs):
+        with update_passed_args():
+            given_that.passed_arg('worker_queue_size').is_set_to(2)
+        release = Event()
+        running_job = threaded_media_lights_sync.submit_job(release.wait)
+
+        for url in [color_images['red_and_white'], rgb_images[0], rgb_images[1]]:
+            media_player('media_player.tv_test').update_state('playing', {"entity_picture": url})
+        assert threaded_media_lights_sync.media_player_callbacks['media_player.tv_test'][1] == rgb_images[1]
+        release.set()
+        running_job.result()
+        threaded_media_lights_sync.workers.shutdown(wait=True)
+        threaded_media_lights_sync.dispatcher.wait_idle()
+
+        assert any("replaced the queued artwork job of 'media_player.tv_test'" in log for log in hass_logs())
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 2
+        assert_that('light.test_light_1').was.turned_on(brightness=255, rgb_color=[111, 11, 24])
+        assert threaded_media_lights_sync.pending_jobs == 0
+        assert threaded_media_lights_sync.coalesced_jobs == 2
+
+    def test_dropped_job_is_not_marked_as_processed(self, threaded_media_lights_sync, media_player):
+        release = Event()
+        running_job = threaded_media_lights_sync.submit_job(release.wait)
+
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+        release.set()
+        running_job.result()
+
+        assert 'media_player.tv_test' not in threaded_media_lights_sync.media_player_callbacks
+
+    def test_fetch_errors_are_handled_by_workers(self, threaded_media_lights_sync, media_player, hass_errors):
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": "file:///example-404.jpg"})
+        threaded_media_lights_sync.workers.shutdown(wait=True)
+
+        assert any('Unable to fetch artwork' in log for log in hass_errors())
+        assert threaded_media_lights_sync.media_player_callbacks == {}
+
+
+class TestSupersededJobs:
+    def test_debounce_keeps_latest_artwork(self, media_lights_sync, media_player, update_passed_args, given_that,
+                                           assert_that, hass_mocks, time_travel):
+        with update_passed_args():
+            given_that.passed_arg('debounce').is_set_to(1)
+
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[1]})
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 0
+        time_travel.fast_forward(1).seconds()
+        media_lights_sync.dispatcher.wait_idle()
+
+        assert_that('light.test_light_1').was_not.turned_on(brightness=255, rgb_color=[59, 180, 180])
+        assert_that('light.test_light_1').was.turned_on(brightness=255, rgb_color=[111, 11, 24])
+        assert media_lights_sync.coalesced_jobs == 1
+
+    def test_dropped_debounced_job_does_not_supersede_running_job(self, media_lights_sync, media_player, update_passed_args, given_that,
+                                                                  assert_that, time_travel):
+        with update_passed_args():
+            given_that.passed_arg('worker_threads').is_set_to(1)
+            given_that.passed_arg('worker_queue_size').is_set_to(1)
+            given_that.passed_arg('debounce').is_set_to(1)
+        started, release = Event(), Event()
+        get_colors = media_lights_sync.get_colors
+
+        def blocked_get_colors(url):
+            started.set()
+            release.wait()
+            return get_colors(url)
+
+        with mock.patch.object(media_lights_sync, 'get_colors', side_effect=blocked_get_colors):
+            media_lights_sync.submit_artwork_job('media_player.tv_test', rgb_images[0], None)
+            started.wait()
+            media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[1]})
+            time_travel.fast_forward(1).seconds()
+            release.set()
+            media_lights_sync.workers.shutdown(wait=True)
+        media_lights_sync.dispatcher.wait_idle()
+
+        assert_that('light.test_light_1').was.turned_on(brightness=255, rgb_color=[59, 180, 180])
+        assert media_lights_sync.coalesced_jobs == 0
+
+    def test_superseded_colors_never_reach_lights(self, media_lights_sync, hass_mocks):
+        job = media_lights_sync.new_job('media_player.tv_test')
+        get_colors = media_lights_sync.get_colors
+
+        def get_colors_then_supersede(url):
+            media_lights_sync.new_job('media_player.tv_test')
+            return get_colors(url)
+
+        with mock.patch.object(media_lights_sync, 'get_colors', side_effect=get_colors_then_supersede):
+            media_lights_sync.sync_lights('media_player.tv_test', rgb_images[0], job)
+
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 0
+        assert media_lights_sync.coalesced_jobs == 1
+
+
+class TestLightDispatcher:
+    @pytest.fixture
+    def blocked_dispatcher(self, media_lights_sync, hass_mocks):
+        """Dispatcher whose single thread is busy with a call until release is set."""
+        release = Event()
+        dispatcher = LightDispatcher(media_lights_sync, 1, None)
+        hass_mocks.hass_functions["turn_off"].side_effect = lambda *args, **kwargs: release.wait()
+        dispatcher.send('light.blocking', "turn_off", {})
+        dispatcher.release = release
+        yield dispatcher
+        release.set()
+        dispatcher.stop()
+
+    def test_only_latest_command_of_a_light_is_sent(self, blocked_dispatcher, hass_mocks):
+        for brightness in range(3):
+            blocked_dispatcher.send('light.test_light_2', "turn_on", {"brightness": brightness})
+        blocked_dispatcher.release.set()
+        blocked_dispatcher.wait_idle()
+
+        hass_mocks.hass_functions["turn_on"].assert_called_once_with('light.test_light_2', brightness=2)
+        assert blocked_dispatcher.replaced == 2
+
+    def test_identical_commands_are_batched(self, blocked_dispatcher, hass_mocks, assert_that):
+        blocked_dispatcher.send('light.test_light_1', "turn_on", {"rgb_color": [255, 0, 0]})
+        blocked_dispatcher.send('light.test_light_2', "turn_on", {"rgb_color": [0, 0, 255]})
+        blocked_dispatcher.send('light.test_light_3', "turn_on", {"rgb_color": [255, 0, 0]})
+        blocked_dispatcher.release.set()
+        blocked_dispatcher.wait_idle()
+
+        assert_that('light/turn_on').was.called_with(entity_id=['light.test_light_1', 'light.test_light_3'], rgb_color=[255, 0, 0])
+        assert_that('light.test_light_2').was.turned_on(rgb_color=[0, 0, 255])
+        assert "lights: 4" in blocked_dispatcher.stats()
+
+    def test_palette_commands_are_batched(self, media_lights_sync, hass_mocks, assert_that):
+        with mock.patch.object(media_lights_sync, 'get_colors', return_value=[[255, 0, 0], [255, 0, 0]]):
+            for _ in range(20):
+                media_lights_sync.sync_lights('media_player.tv_test', rgb_images[0])
+                media_lights_sync.dispatcher.wait_idle()
+
+        assert_that('light/turn_on').was.called_with(entity_id=['light.test_light_1', 'light.test_light_2'], brightness=255, rgb_color=[255, 0, 0])
+        assert len(hass_mocks.hass_functions["call_service"].call_args_list) == 20
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 0
+
+    def test_reset_commands_are_batched(self, media_lights_sync, media_player, update_passed_args, given_that, assert_that, hass_mocks):
+        with update_passed_args():
+            given_that.passed_arg('reset_lights_after').is_set_to(True)
+            given_that.state_of('light.test_light_1').is_set_to('off')
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+        given_that.mock_functions_are_cleared()
+
+        media_player('media_player.tv_test').update_state('idle')
+
+        assert_that('light/turn_off').was.called_with(entity_id=['light.test_light_1', 'light.test_light_2'])
+        assert len(hass_mocks.hass_functions["turn_off"].call_args_list) == 0
+
+    def test_rate_limit(self, media_lights_sync, hass_mocks):
+        dispatcher = LightDispatcher(media_lights_sync, 2, 20)
+        start = time.monotonic()
+        for i in range(3):
+            dispatcher.send('light.test_light_{i}'.format(i=i), "turn_on", {"brightness": i})
+        dispatcher.wait_idle()
+
+        assert time.monotonic() - start >= 0.1
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 3
+        dispatcher.stop()
+
+    def test_service_errors_are_logged(self, media_lights_sync, hass_mocks, hass_errors):
+        hass_mocks.hass_functions["turn_on"].side_effect = ValueError("unknown light")
+
+        media_lights_sync.dispatcher.send('light.test_light_1', "turn_on", {})
+        media_lights_sync.dispatcher.wait_idle()
+
+        assert any("Unable to update ['light.test_light_1'] light(s): unknown light" in log for log in hass_errors())
+
+
+class TestRedundantCommands:
+    @pytest.fixture
+    def diffing_media_lights_sync(self, media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('color_delta_threshold').is_set_to(3)
+        return media_lights_sync
+
+    def set_light_and_wait(self, media_lights_sync, color, brightness=255):
+        media_lights_sync.set_light("on", 'light.test_light_1', color=color, brightness=brightness)
+        media_lights_sync.dispatcher.wait_idle()
+
+    def test_ciede2000(self):
+        assert ciede2000([50, 2.6772, -79.7751], [50, 0, -82.7485]) == pytest.approx(2.0425, abs=1e-4)
+        assert ciede2000([50, 2.5, 0], [73, 25, -18]) == pytest.approx(27.1492, abs=1e-4)
+        assert ciede2000(rgb_to_lab([10, 20, 30]), rgb_to_lab([10, 20, 30])) == 0
+
+    def test_commands_are_sent_by_default(self, media_lights_sync, hass_mocks):
+        self.set_light_and_wait(media_lights_sync, [59, 180, 180])
+        self.set_light_and_wait(media_lights_sync, [59, 180, 180])
+
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 2
+
+    def test_similar_colors_are_suppressed(self, diffing_media_lights_sync, hass_mocks, hass_logs):
+        self.set_light_and_wait(diffing_media_lights_sync, [59, 180, 180])
+        self.set_light_and_wait(diffing_media_lights_sync, [60, 181, 180])
+
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 1
+        assert "Skipped unchanged 'light.test_light_1' light (1 suppressed)" in hass_logs()
+
+    def test_commands_are_sent_after_light_changed_outside_of_the_app(self, diffing_media_lights_sync, hass_mocks, hass_logs, assert_that):
+        assert_that(diffing_media_lights_sync).\
+            listens_to.state('light.test_light_1', attribute='all').with_callback(diffing_media_lights_sync.light_changed)
+        self.set_light_and_wait(diffing_media_lights_sync, [59, 180, 180])
+        diffing_media_lights_sync.light_changed('light.test_light_1', 'state', None, {'state': 'off', 'attributes': {}}, None)
+        self.set_light_and_wait(diffing_media_lights_sync, [60, 181, 180])
+
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 2
+        assert "'light.test_light_1' light was changed outside of the app" in hass_logs()
+
+    def test_echoes_of_sent_commands_are_ignored(self, diffing_media_lights_sync, hass_mocks):
+        self.set_light_and_wait(diffing_media_lights_sync, [59, 180, 180])
+        echo = {'state': 'on', 'attributes': {'brightness': 255, 'rgb_color': [58, 180, 181]}}
+        diffing_media_lights_sync.light_changed('light.test_light_1', 'state', None, echo, None)
+        self.set_light_and_wait(diffing_media_lights_sync, [60, 181, 180])
+
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 1
+
+    def test_echoes_with_normalized_colors_are_ignored(self, diffing_media_lights_sync, hass_mocks, hass_logs):
+        self.set_light_and_wait(diffing_media_lights_sync, [59, 180, 180])
+        echo = {'state': 'on', 'attributes': {'brightness': 255, 'rgb_color': [84, 255, 255]}}
+        diffing_media_lights_sync.light_changed('light.test_light_1', 'state', None, echo, None)
+        self.set_light_and_wait(diffing_media_lights_sync, [59, 180, 180])
+
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 1
+        assert "'light.test_light_1' light was changed outside of the app" not in hass_logs()
+
+    def test_different_colors_or_brightness_are_sent(self, diffing_media_lights_sync, hass_mocks):
+        self.set_light_and_wait(diffing_media_lights_sync, [59, 180, 180])
+        self.set_light_and_wait(diffing_media_lights_sync, [46, 56, 110])
+        self.set_light_and_wait(diffing_media_lights_sync, [46, 56, 110], brightness=100)
+
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 3
+
+
+class TestInterpolation:
+    @pytest.fixture
+    def interpolating_media_lights_sync(self, media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('interpolation').is_set_to(0.2)
+            given_that.passed_arg('interpolation_frames').is_set_to(4)
+        return media_lights_sync
+
+    def light_colors(self, hass_mocks, entity):
+        return [call[1]["rgb_color"] for call in hass_mocks.hass_functions["turn_on"].call_args_list if call[0][0] == entity]
+
+    def test_lab_to_rgb(self):
+        for color in [[0, 0, 0], [255, 255, 255], [59, 180, 180], [153, 68, 106], [255, 0, 0]]:
+            assert lab_to_rgb(rgb_to_lab(color)) == color
+
+    def test_first_palette_is_set_directly(self, interpolating_media_lights_sync, media_player, hass_mocks):
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+        interpolating_media_lights_sync.interpolator.wait_idle()
+        interpolating_media_lights_sync.dispatcher.wait_idle()
+
+        assert self.light_colors(hass_mocks, 'light.test_light_1') == [[59, 180, 180]]
+        assert self.light_colors(hass_mocks, 'light.test_light_2') == [[46, 56, 110]]
+
+    def test_palettes_are_interpolated(self, interpolating_media_lights_sync, hass_mocks):
+        interpolating_media_lights_sync.last_applied_states['light.test_light_1'] = ("on", [0, 0, 0], "rgb_color", 255, None)
+        interpolating_media_lights_sync.interpolator.start({'light.test_light_1': [255, 255, 255]}, 255)
+        interpolating_media_lights_sync.interpolator.wait_idle()
+        interpolating_media_lights_sync.dispatcher.wait_idle()
+
+        colors = self.light_colors(hass_mocks, 'light.test_light_1')
+        assert 1 < len(colors) <= 4
+        assert colors[-1] == [255, 255, 255]
+        assert colors == sorted(colors)
+
+    def test_new_palette_cancels_pending_frames(self, media_lights_sync, update_passed_args, given_that, hass_mocks):
+        with update_passed_args():
+            given_that.passed_arg('interpolation').is_set_to(10)
+            given_that.passed_arg('interpolation_frames').is_set_to(2)
+        interpolator = media_lights_sync.interpolator
+        media_lights_sync.last_applied_states['light.test_light_1'] = ("on", [0, 0, 0], "rgb_color", 255, None)
+        interpolator.start({'light.test_light_1': [255, 255, 255]}, 255)
+        while not self.light_colors(hass_mocks, 'light.test_light_1'):
+            time.sleep(0.01)  # first frame sent
+        interpolator.cancel()
+
+        assert interpolator.wait_idle(timeout=1)
+        media_lights_sync.dispatcher.wait_idle()
+        assert interpolator.cancelled == 1
+        assert len(self.light_colors(hass_mocks, 'light.test_light_1')) == 1
+
+    def test_frames_cancelled_while_computed_are_not_sent(self, media_lights_sync, update_passed_args, given_that, hass_mocks):
+        with update_passed_args():
+            given_that.passed_arg('interpolation').is_set_to(10)
+            given_that.passed_arg('interpolation_frames').is_set_to(2)
+        interpolator = media_lights_sync.interpolator
+        media_lights_sync.last_applied_states['light.test_light_1'] = ("on", [0, 0, 0], "rgb_color", 255, None)
+
+        def cancel_frame(lab):
+            interpolator.cancel()
+            return lab_to_rgb(lab)
+
+        with mock.patch('apps.media_lights_sync.media_lights_sync.lab_to_rgb', side_effect=cancel_frame):
+            interpolator.start({'light.test_light_1': [255, 255, 255]}, 255)
+            assert interpolator.wait_idle(timeout=1)
+        media_lights_sync.dispatcher.wait_idle()
+
+        assert interpolator.cancelled == 1
+        assert self.light_colors(hass_mocks, 'light.test_light_1') == []
+
+
+class TestColorAssignment:
+    @pytest.fixture
+    def assigning_media_lights_sync(self, media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('color_assignment').is_set_to('nearest')
+        return media_lights_sync
+
+    def test_min_cost_assignment(self):
+        assert min_cost_assignment([[4, 1, 3], [2, 0, 5], [3, 2, 2]]) == [1, 0, 2]
+        assert min_cost_assignment([[1, 0, 3], [0, 2, 0]]) == [1, 0]
+
+    def test_palette_order_is_kept_without_current_colors(self, assigning_media_lights_sync):
+        assert assigning_media_lights_sync.assign_colors([[255, 0, 0], [0, 0, 255]]) == [[255, 0, 0], [0, 0, 255]]
+
+    def test_dominant_color_goes_to_the_heaviest_light(self, media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('color_assignment').is_set_to('nearest')
+            given_that.passed_arg('light_weights').is_set_to([1, 3])
+
+        assert media_lights_sync.assign_colors([[255, 0, 0], [0, 0, 255]]) == [[0, 0, 255], [255, 0, 0]]
+
+    @pytest.mark.parametrize("weights", [[1], [0, 0], [2, -1], [1, 2, 3]])
+    def test_invalid_weights_are_ignored(self, media_lights_sync, update_passed_args, given_that, hass_logs, weights):
+        with update_passed_args():
+            given_that.passed_arg('color_assignment').is_set_to('nearest')
+            given_that.passed_arg('light_weights').is_set_to(weights)
+
+        assert media_lights_sync.light_weights == [1, 1]
+        assert "light_weights must have one positive number per light, using equal weights." in hass_logs()
+        assert media_lights_sync.assign_colors([[255, 0, 0], [0, 0, 255]]) == [[255, 0, 0], [0, 0, 255]]
+
+    def test_saturated_colors_are_assigned(self, assigning_media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('use_saturated_colors').is_set_to(True)
+        pale_blue, orange = [200, 230, 250], [250, 200, 150]
+        saturated_blue = assigning_media_lights_sync.get_saturated_color(pale_blue)
+        assigning_media_lights_sync.last_applied_states['light.test_light_1'] = ("on", saturated_blue, "rgb_color", 255, None)
+        assigning_media_lights_sync.last_applied_states['light.test_light_2'] = ("on", pale_blue, "rgb_color", 255, None)
+
+        with mock.patch.object(assigning_media_lights_sync, 'get_colors', return_value=[pale_blue, orange]):
+            assigning_media_lights_sync.sync_lights('media_player.tv_test', rgb_images[0])
+
+        assert assigning_media_lights_sync.get_applied_color('light.test_light_1') == saturated_blue
+        assert assigning_media_lights_sync.get_applied_color('light.test_light_2') == assigning_media_lights_sync.get_saturated_color(orange)
+
+    def test_lights_keep_their_closest_color(self, assigning_media_lights_sync, media_player, assert_that):
+        assigning_media_lights_sync.last_applied_states['light.test_light_1'] = ("on", [40, 50, 120], "rgb_color", 255, None)
+        assigning_media_lights_sync.last_applied_states['light.test_light_2'] = ("on", [60, 170, 170], "rgb_color", 255, None)
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+
+        assert_that('light.test_light_1').was.turned_on(brightness=255, rgb_color=[46, 56, 110])
+        assert_that('light.test_light_2').was.turned_on(brightness=255, rgb_color=[59, 180, 180])
+
+
+class TestLightCapabilities:
+    @pytest.fixture
+    def capable_media_lights_sync(self, media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.state_of('light.test_light_1').is_set_to('on', {'supported_color_modes': ['color_temp', 'xy']})
+            given_that.state_of('light.test_light_2').is_set_to('off', {
+                'supported_color_modes': ['color_temp'], 'min_color_temp_kelvin': 2700, 'max_color_temp_kelvin': 5000})
+        return media_lights_sync
+
+    def test_color_conversions(self):
+        assert rgb_to_xy([255, 255, 255]) == [0.3127, 0.329]
+        assert rgb_to_xy([255, 0, 0]) == pytest.approx([0.64, 0.33], abs=1e-3)
+        assert nearest_kelvin([0.3127, 0.329], 2000, 10000) == pytest.approx(6500, abs=100)
+        assert nearest_kelvin([0.4476, 0.4074], 2000, 10000) == pytest.approx(2856, abs=50)
+        assert nearest_kelvin(rgb_to_xy([46, 56, 110]), 2700, 5000) == 5000
+
+    def test_capabilities_are_read_and_refreshed(self, capable_media_lights_sync, given_that, assert_that):
+        assert capable_media_lights_sync.light_capabilities['light.test_light_1']['mode'] == 'xy'
+        assert_that(capable_media_lights_sync).\
+            listens_to.state('light.test_light_1', attribute='supported_color_modes').\
+            with_callback(capable_media_lights_sync.update_light_capabilities)
+
+        given_that.state_of('light.test_light_1').is_set_to('on', {'supported_color_modes': ['hs']})
+        capable_media_lights_sync.update_light_capabilities('light.test_light_1', 'supported_color_modes', ['xy'], ['hs'], None)
+
+        assert capable_media_lights_sync.light_capabilities['light.test_light_1']['mode'] == 'hs'
+
+    def test_colors_are_sent_in_native_modes(self, capable_media_lights_sync, media_player, assert_that):
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+
+        assert_that('light.test_light_1').was.turned_on(brightness=255, xy_color=rgb_to_xy([59, 180, 180]))
+        assert_that('light.test_light_2').was.turned_on(brightness=255, color_temp_kelvin=5000)
+
+    @pytest.mark.parametrize("mode, expected", [
+        ('rgb', {'rgb_color': [200, 150, 100]}),
+        ('rgbw', {'rgbw_color': [100, 50, 0, 100]}),
+        ('rgbww', {'rgbww_color': [100, 50, 0, 50, 50]}),
+        ('hs', {'hs_color': [30.0, 50.0]}),
+        ('brightness', {}),
+    ])
+    def test_color_encoding(self, media_lights_sync, mode, expected):
+        media_lights_sync.light_capabilities['light.test_light_1'] = media_lights_sync.get_light_capabilities(
+            {'attributes': {'supported_color_modes': [mode]}})
+
+        assert media_lights_sync.encode_color('light.test_light_1', [200, 150, 100]) == expected
+
+    def test_lights_without_color_modes_get_rgb(self, media_lights_sync):
+        assert media_lights_sync.encode_color('light.test_light_1', [200, 150, 100]) == {'rgb_color': [200, 150, 100]}
+
+
+class TestArtworkFetcher:
+    @pytest.fixture
+    def artwork_server(self):
+        connections = []
+        statuses = []
+        conditions = []
+
+        class ArtworkHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                connections.append(self.client_address)
+
+            def do_GET(self):
+                if self.path == "/redirect":
+                    return self.send_body(302, b"", {"Location": "/example-1.jpg"})
+                if self.path == "/slow.jpg":
+                    time.sleep(1)
+                if self.path == "/missing.jpg":
+                    return self.send_body(404, b"")
+                conditions.append((self.headers.get("If-None-Match"), self.headers.get("If-Modified-Since")))
+                if self.headers.get("If-None-Match") == '"example-1"':
+                    return self.send_body(304, b"")
+                try:
+                    with open(image_path("../../examples/example-1.jpg"), "rb") as image:
+                        self.send_body(200, image.read(), {"ETag": '"example-1"', "Last-Modified": "Sat, 17 Oct 2026 10:00:00 GMT"})
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def send_body(self, status, body, headers={}):
+                statuses.append(status)
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), ArtworkHandler)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, daemon=True).start()
+        server.connections = connections
+        server.statuses = statuses
+        server.conditions = conditions
+        server.url = "http://127.0.0.1:{port}".format(port=server.server_port)
+        yield server
+        server.shutdown()
+        server.server_close()
+
+    def test_connections_are_reused(self, media_lights_sync, artwork_server):
+        colors = media_lights_sync.get_colors(artwork_server.url + "/example-1.jpg")
+
+        assert media_lights_sync.get_colors(artwork_server.url + "/example-1.jpg?cache=1") == colors
+        assert colors == media_lights_sync.get_colors(rgb_images[0])
+        assert len(artwork_server.connections) == 1
+
+    def test_redirects_are_followed(self, media_lights_sync, artwork_server):
+        assert media_lights_sync.get_colors(artwork_server.url + "/redirect") == media_lights_sync.get_colors(rgb_images[0])
+
+    def test_http_errors_are_raised(self, media_lights_sync, artwork_server):
+        with pytest.raises(HTTPError):
+            media_lights_sync.fetch_image(artwork_server.url + "/missing.jpg")
+
+    def test_downloads_are_limited_in_size(self, media_lights_sync, artwork_server, update_passed_args, given_that, media_player, hass_errors):
+        with update_passed_args():
+            given_that.passed_arg('max_download_size').is_set_to(0.01)
+
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": artwork_server.url + "/example-1.jpg"})
+
+        assert any('Unable to fetch artwork' in log and 'larger than 10485 bytes' in log for log in hass_errors())
+
+    def test_unmodified_artwork_reuses_palette(self, media_lights_sync, artwork_server, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('palette_cache_size').is_set_to(2)
+        colors = media_lights_sync.get_colors(artwork_server.url + "/example-1.jpg?track=1")
+        media_lights_sync.palette_cache.urls.clear()  # e.g. evicted by URL, but still known by digest
+
+        with mock.patch.object(media_lights_sync, 'extract_image_colors') as extract_image_colors:
+            assert media_lights_sync.get_colors(artwork_server.url + "/example-1.jpg?track=1") == colors
+
+        extract_image_colors.assert_not_called()
+        assert artwork_server.statuses == [200, 304]
+        assert artwork_server.conditions == [(None, None), ('"example-1"', "Sat, 17 Oct 2026 10:00:00 GMT")]
+
+    def test_busted_urls_are_revalidated_with_strong_etags_only(self, media_lights_sync, artwork_server, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('palette_cache_size').is_set_to(2)
+        colors = media_lights_sync.get_colors(artwork_server.url + "/example-1.jpg?track=1")
+
+        with mock.patch.object(media_lights_sync, 'extract_image_colors') as extract_image_colors:
+            assert media_lights_sync.get_colors(artwork_server.url + "/example-1.jpg?track=2") == colors
+
+        extract_image_colors.assert_not_called()
+        assert artwork_server.statuses == [200, 304]
+        assert artwork_server.conditions == [(None, None), ('"example-1"', None)]
+
+    def test_unmodified_artwork_is_downloaded_again_if_evicted(self, media_lights_sync, artwork_server, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('palette_cache_size').is_set_to(1)
+        colors = media_lights_sync.get_colors(artwork_server.url + "/example-1.jpg?track=1")
+        media_lights_sync.get_colors(rgb_images[1])
+
+        assert media_lights_sync.get_colors(artwork_server.url + "/example-1.jpg?track=1") == colors
+        assert artwork_server.statuses == [200, 200]
+        assert artwork_server.conditions == [(None, None), (None, None)]
+
+    def test_stalled_downloads_time_out(self, media_lights_sync, artwork_server, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('read_timeout').is_set_to(0.2)
+
+        with pytest.raises(URLError):
+            media_lights_sync.fetch_image(artwork_server.url + "/slow.jpg")
+
+
+class TestMetrics:
+    def test_metrics_are_disabled_by_default(self, media_lights_sync, media_player, hass_mocks):
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+
+        assert isinstance(media_lights_sync.metrics, NullMetrics)
+        hass_mocks.hass_functions["set_state"].assert_not_called()
+
+    def test_metrics_are_published_as_sensor(self, media_lights_sync, media_player, update_passed_args, given_that, hass_mocks):
+        with update_passed_args():
+            given_that.passed_arg('metrics').is_set_to({"sensor": "sensor.tv_lights_latency"})
+
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+
+        args, kwargs = hass_mocks.hass_functions["set_state"].call_args
+        assert args == ("sensor.tv_lights_latency",)
+        assert isinstance(kwargs["state"], int)
+        assert kwargs["attributes"]["artworks"] == 1
+        for stage in ["condition", "resolve", "fetch", "decode", "quantize", "end_to_end"]:
+            assert stage + "_p50_ms" in kwargs["attributes"]
+        assert media_lights_sync.metrics.percentiles("dispatch") is not None
+
+    def test_default_sensor_is_named_after_the_app(self, media_lights_sync, update_passed_args, given_that):
+        media_lights_sync.name = "Living-Room TV"
+        with update_passed_args():
+            given_that.passed_arg('metrics').is_set_to(True)
+
+        assert media_lights_sync.metrics_sensor == "sensor.living_room_tv_metrics"
+
+    def test_prometheus_route(self, media_lights_sync, media_player, update_passed_args, given_that):
+        with mock.patch.object(MediaLightsSync, 'register_route') as register_route:
+            with update_passed_args():
+                given_that.passed_arg('metrics').is_set_to({"prometheus": True})
+
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+        text = media_lights_sync.metrics.prometheus()
+
+        register_route.assert_called_once_with(media_lights_sync.metrics_route)
+        assert 'media_lights_sync_stage_seconds{stage="fetch",quantile="0.5"}' in text
+        assert 'media_lights_sync_stage_seconds_count{stage="quantize"} 1' in text
+        assert 'media_lights_sync_events_total{event="artworks"} 1' in text
+
+    def test_percentiles(self):
+        metrics = Metrics(100)
+        for i in range(1, 101):
+            metrics.record("fetch", i / 1000)
+
+        assert metrics.percentiles("fetch") == [0.051, 0.091, 0.1]
+        assert metrics.percentiles("decode") is None
+
+
+class TestSharedArtworkPipeline:
+    @pytest.fixture
+    def shared_media_lights_sync(self, media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('share_artwork').is_set_to(True)
+        yield media_lights_sync
+        media_lights_sync.terminate()
+
+    def test_concurrent_requests_are_processed_once(self):
+        pipeline = SharedArtworkPipeline()
+        release = Event()
+        compute = mock.Mock(side_effect=lambda: release.wait() and [[1, 2, 3]])
+        results = []
+        threads = [Thread(target=lambda: results.append(pipeline.get_colors("settings", "url", compute))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while pipeline.deduplicated < 2:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert compute.call_count == 1
+        assert results == [[[1, 2, 3]]] * 3
+
+    def test_errors_are_shared_with_waiting_requests(self):
+        pipeline = SharedArtworkPipeline()
+
+        with pytest.raises(URLError):
+            pipeline.get_colors("settings", "url", mock.Mock(side_effect=URLError("unreachable")))
+        assert pipeline.in_flight == {}
+
+    def test_palette_is_extracted_at_highest_light_count(self, shared_media_lights_sync):
+        SHARED_PIPELINE.register(shared_media_lights_sync.extraction_settings(), "other_room", 5)
+        try:
+            with mock.patch.object(shared_media_lights_sync, 'extract_image_colors',
+                                   wraps=shared_media_lights_sync.extract_image_colors) as extract_image_colors:
+                colors = shared_media_lights_sync.get_colors(rgb_images[0])
+        finally:
+            SHARED_PIPELINE.unregister("other_room")
+
+        assert extract_image_colors.call_args[0][1] == 5
+        assert len(colors) == 2
+
+    def test_apps_are_unregistered_on_terminate(self, shared_media_lights_sync):
+        settings = shared_media_lights_sync.extraction_settings()
+        assert SHARED_PIPELINE.light_count(settings) == 2
+
+        shared_media_lights_sync.terminate()
+
+        assert SHARED_PIPELINE.light_count(settings) == 0
+
+
+class TestPrefetch:
+    @pytest.fixture
+    def prefetching_media_lights_sync(self, media_lights_sync, update_passed_args, given_that):
+        with update_passed_args():
+            given_that.passed_arg('prefetch_attributes').is_set_to(['next_entity_picture'])
+        return media_lights_sync
+
+    def test_callbacks_are_set_for_prefetch_attributes(self, prefetching_media_lights_sync, assert_that):
+        assert_that(prefetching_media_lights_sync).\
+            listens_to.state('media_player.tv_test', attribute='next_entity_picture').\
+            with_callback(prefetching_media_lights_sync.prefetch_artwork)
+        assert prefetching_media_lights_sync.palette_cache.size > 0
+
+    def test_prefetched_artwork_is_applied_without_fetching(self, prefetching_media_lights_sync, media_player, assert_that, hass_mocks):
+        prefetching_media_lights_sync.prefetch_artwork('media_player.tv_test', 'next_entity_picture', None, [rgb_images[1]], None)
+        prefetching_media_lights_sync.prefetcher.submit(lambda: None).result()
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 0
+
+        with mock.patch.object(prefetching_media_lights_sync, 'fetch_image') as fetch_image:
+            media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[1]})
+
+        fetch_image.assert_not_called()
+        assert_that('light.test_light_1').was.turned_on(brightness=255, rgb_color=[111, 11, 24])
+        assert_that('light.test_light_2').was.turned_on(brightness=255, rgb_color=[153, 68, 106])
+
+    def test_prefetch_errors_are_only_logged(self, prefetching_media_lights_sync, hass_logs, hass_errors):
+        prefetching_media_lights_sync.prefetch_artwork('media_player.tv_test', 'next_entity_picture', None, "file:///example-404.jpg", None)
+        prefetching_media_lights_sync.prefetcher.submit(lambda: None).result()
+
+        assert any('Unable to prefetch artwork' in log for log in hass_logs())
+        assert hass_errors() == []
+
+    def test_prefetches_never_run_on_the_callback_thread(self, prefetching_media_lights_sync):
+        threads = []
+        with mock.patch.object(prefetching_media_lights_sync, 'prefetch_colors', side_effect=lambda url: threads.append(current_thread().name)):
+            prefetching_media_lights_sync.prefetch_artwork('media_player.tv_test', 'next_entity_picture', None, [rgb_images[1]], None)
+            prefetching_media_lights_sync.prefetcher.submit(lambda: None).result()
+
+        assert len(threads) == 1
+        assert threads[0].startswith("media_lights_sync_prefetch")
+
+    def test_artwork_jobs_evict_queued_prefetches(self, prefetching_media_lights_sync, media_player, update_passed_args,
+                                                  given_that, assert_that, hass_logs):
+        with update_passed_args():
+            given_that.passed_arg('worker_threads').is_set_to(1)
+            given_that.passed_arg('worker_queue_size').is_set_to(2)
+        release = Event()
+        running_job = prefetching_media_lights_sync.submit_job(release.wait)
+
+        prefetching_media_lights_sync.prefetch_artwork('media_player.tv_test', 'next_entity_picture', None, [rgb_images[1]], None)
+        assert len(prefetching_media_lights_sync.queued_prefetches) == 1
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+        release.set()
+        running_job.result()
+        prefetching_media_lights_sync.workers.shutdown(wait=True)
+        prefetching_media_lights_sync.dispatcher.wait_idle()
+
+        assert any("evicted a queued prefetch for the artwork of 'media_player.tv_test'" in log for log in hass_logs())
+        assert_that('light.test_light_1').was.turned_on(brightness=255, rgb_color=[59, 180, 180])
+        assert prefetching_media_lights_sync.queued_prefetches == set()
+        assert prefetching_media_lights_sync.pending_jobs == 0
+
+
+class TestAmbilight:
+    @pytest.fixture
+    def frame_url(self, tmp_path):
+        frame = Image.new("RGB", (320, 180), (0, 0, 255))
+        frame.paste((255, 0, 0), (0, 0, 160, 180))
+        frame.save(str(tmp_path / "frame.png"))
+        return "file://" + str(tmp_path / "frame.png")
+
+    @pytest.fixture
+    def ambilight_media_lights_sync(self, media_lights_sync, update_passed_args, given_that, frame_url):
+        given_that.state_of('media_player.tv_test').is_set_to('off')
+        with update_passed_args():
+            given_that.passed_arg('ambilight').is_set_to({'source': frame_url, 'fps': 20})
+        yield media_lights_sync
+        media_lights_sync.ambilight.stop()
+
+    def test_callbacks_are_set_on_media_player_state(self, ambilight_media_lights_sync, assert_that):
+        assert_that(ambilight_media_lights_sync).\
+            listens_to.state('media_player.tv_test').with_callback(ambilight_media_lights_sync.toggle_ambilight)
+
+    def test_ambilight_starts_if_already_playing(self, media_lights_sync, update_passed_args, given_that, frame_url, assert_that, hass_logs):
+        given_that.state_of('media_player.tv_test').is_set_to('playing')
+        with update_passed_args():
+            given_that.passed_arg('ambilight').is_set_to({'source': frame_url, 'fps': 20})
+            given_that.passed_arg('prefetch_attributes').is_set_to(['next_entity_picture'])
+
+        assert media_lights_sync.ambilight.active
+        assert "Artwork pictures and prefetch_attributes are ignored in ambilight mode" in hass_logs()
+        while media_lights_sync.ambilight.frames < 1:
+            time.sleep(0.01)
+        media_lights_sync.ambilight.stop()
+        media_lights_sync.dispatcher.wait_idle()
+        assert_that('light.test_light_1').was.turned_on(brightness=255, rgb_color=[255, 0, 0])
+
+    def test_regions_colors_are_extracted(self, media_lights_sync, frame_url):
+        with open(frame_url[len("file://"):], "rb") as f:
+            data = f.read()
+        regions = media_lights_sync.get_ambilight_regions(["left", [0.4, 0, 0.45, 1]]) + [(0.5, 0, 1, 1)]
+
+        assert media_lights_sync.extract_region_colors(data, regions) == [[255, 0, 0], [255, 0, 0], [0, 0, 255]]
+
+    def test_default_regions_are_vertical_strips(self, media_lights_sync):
+        assert media_lights_sync.get_ambilight_regions(None) == [(0, 0, 0.5, 1), (0.5, 0, 1, 1)]
+
+    def test_regions_must_match_lights(self, media_lights_sync, hass_logs):
+        assert media_lights_sync.get_ambilight_regions(["left"]) == [(0, 0, 0.5, 1), (0.5, 0, 1, 1)]
+        assert "Ambilight regions must have one region per light, using vertical strips." in hass_logs()
+
+    def test_unavailable_camera_frames_are_skipped(self, ambilight_media_lights_sync, given_that, hass_mocks):
+        ambilight_media_lights_sync.ambilight_source = 'camera.tv'
+        given_that.state_of('camera.tv').is_set_to('unavailable', {'entity_picture': None})
+
+        with mock.patch.object(ambilight_media_lights_sync, 'fetch_image') as fetch_image:
+            ambilight_media_lights_sync.sync_frame()
+
+        fetch_image.assert_not_called()
+        assert len(hass_mocks.hass_functions["turn_on"].call_args_list) == 0
+
+    def test_lights_follow_frames_while_playing(self, ambilight_media_lights_sync, given_that, assert_that):
+        given_that.state_of('media_player.tv_test').is_set_to('playing')
+        ambilight_media_lights_sync.toggle_ambilight('media_player.tv_test', 'state', 'paused', 'playing', None)
+        while ambilight_media_lights_sync.ambilight.frames < 2:
+            time.sleep(0.01)
+        ambilight_media_lights_sync.dispatcher.wait_idle()
+
+        assert_that('light.test_light_1').was.turned_on(brightness=255, rgb_color=[255, 0, 0])
+        assert_that('light.test_light_2').was.turned_on(brightness=255, rgb_color=[0, 0, 255])
+
+        given_that.state_of('media_player.tv_test').is_set_to('paused')
+        ambilight_media_lights_sync.toggle_ambilight('media_player.tv_test', 'state', 'playing', 'paused', None)
+        assert not ambilight_media_lights_sync.ambilight.active
+
+    def test_frames_are_skipped_when_behind(self):
+        app = mock.Mock(sync_frame=lambda: time.sleep(0.12))
+        ambilight = AmbilightLoop(app, 20, 1)
+        ambilight.resume()
+        time.sleep(0.3)
+        ambilight.stop()
+
+        assert ambilight.skipped >= 2
+        assert ambilight.frames <= 3
+
+    def test_frame_rate_is_lowered_to_the_cpu_budget(self):
+        def busy_frame():
+            started = time.thread_time()
+            while time.thread_time() - started < 0.02:
+                pass
+
+        ambilight = AmbilightLoop(mock.Mock(sync_frame=busy_frame), 50, 0.1)
+        ambilight.resume()
+        time.sleep(0.5)
+        ambilight.stop()
+
+        assert ambilight.throttled > 0
+        assert ambilight.frames <= 4
+
 
 class TestBehaviors:
     def test_can_change_lights(self, assert_that, media_player, given_that):
@@ -153,8 +1220,8 @@ class TestBehaviors:
 
         media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[1]})
 
-        assert_that('light.test_light_1').was.turned_on(brightness=255, rgb_color=[153, 68, 106])
-        assert_that('light.test_light_2').was.turned_on(brightness=255, rgb_color=[111, 11, 24])
+        assert_that('light.test_light_1').was.turned_on(brightness=255, rgb_color=[111, 11, 24])
+        assert_that('light.test_light_2').was.turned_on(brightness=255, rgb_color=[153, 68, 106])
 
     def test_calling_twice_skips_color_extraction(self, media_player, hass_logs, hass_mocks):
         media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0], "entity_picture_local": rgb_images[0]})
@@ -218,6 +1285,16 @@ class TestResetLights:
         assert_that('light.test_light_2').was.turned_off()
         assert_that('light.test_light_1').was.turned_on(**test_light_1_base_state)
 
+    def test_states_are_read_once_per_entity(self, given_that, media_player, update_passed_args, hass_mocks):
+        with update_passed_args():
+            given_that.passed_arg('reset_lights_after').is_set_to(True)
+        hass_mocks.hass_functions["get_state"].reset_mock()
+
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+
+        assert [call[0] for call in hass_mocks.hass_functions["get_state"].call_args_list] == [
+            ('light.test_light_1',), ('light.test_light_2',), ('media_player.tv_test',)]
+
     def test_wont_reset_lights_if_setting_is_false(self, given_that, media_player, hass_mocks):
         media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
         given_that.mock_functions_are_cleared()
@@ -249,9 +1326,35 @@ class TestResetLights:
 
         media_player('media_player.tv_test').update_state('idle')
 
-        assert_that('light.test_light_1').was.turned_on(color_temp=500, brightness=150)
+        assert_that('light.test_light_1').was.turned_on(color_temp_kelvin=2000, brightness=150)
         assert_that('light.test_light_2').was.turned_on(xy_color=[0.166, 0.269], brightness=100)
 
+    def test_can_reset_color_temperatures_in_kelvin(self, assert_that, media_player, given_that, update_passed_args):
+        with update_passed_args():
+            given_that.passed_arg('reset_lights_after').is_set_to(True)
+        given_that.state_of('light.test_light_1').is_set_to('on', {'color_mode': 'color_temp', 'color_temp_kelvin': 2700, 'brightness': 150})
+
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+        given_that.mock_functions_are_cleared()
+        media_player('media_player.tv_test').update_state('idle')
+
+        assert_that('light.test_light_1').was.turned_on(color_temp_kelvin=2700, brightness=150)
+
+    def test_other_color_modes_are_reset_through_capabilities(self, assert_that, media_player, given_that, update_passed_args):
+        with update_passed_args():
+            given_that.passed_arg('reset_lights_after').is_set_to(True)
+            given_that.state_of('light.test_light_1').is_set_to('on', {
+                'color_mode': 'brightness', 'supported_color_modes': ['brightness'], 'brightness': 150})
+            given_that.state_of('light.test_light_2').is_set_to('on', {
+                'color_mode': 'rgbw', 'supported_color_modes': ['rgbw'], 'rgbw_color': [0, 0, 0, 255], 'brightness': 100})
+
+        media_player('media_player.tv_test').update_state('playing', {"entity_picture": rgb_images[0]})
+        given_that.mock_functions_are_cleared()
+        media_player('media_player.tv_test').update_state('idle')
+
+        assert_that('light.test_light_1').was.turned_on(brightness=150)
+        assert_that('light.test_light_2').was.turned_on(rgbw_color=[0, 0, 0, 255], brightness=100)
+
 
 class TestURLErrors:
     def test_url_error_are_handled(self, media_player, hass_errors, hass_mocks):
@@ -306,6 +1409,18 @@ class TestConditions:
         given_that.state_of(self.condition_entity_id).is_set_to('false')
         assert conditional_media_lights_sync.can_change_colors() == False
 
+    def test_condition_is_cached_until_its_entity_changes(self, given_that, conditional_media_lights_sync, assert_that):
+        assert_that(conditional_media_lights_sync).\
+            listens_to.state(self.condition_entity_id, attribute='all').with_callback(conditional_media_lights_sync.invalidate_condition)
+        given_that.state_of(self.condition_entity_id).is_set_to('on')
+        assert conditional_media_lights_sync.can_change_colors() == True
+
+        given_that.state_of(self.condition_entity_id).is_set_to('off')
+        assert conditional_media_lights_sync.can_change_colors() == True
+
+        conditional_media_lights_sync.invalidate_condition(self.condition_entity_id, 'all', None, None, None)
+        assert conditional_media_lights_sync.can_change_colors() == False
+
 
 class TestTemplateConditions:
     template = "{{ 'test' != 123 and is_state('sun.sun', 'below_horizon') }}"
@@ -328,6 +1443,41 @@ class TestTemplateConditions:
         given_that.state_of('sun.sun').is_set_to('above_horizon')
         assert conditional_template_media_lights_sync.can_change_colors() == False
 
+    def test_template_entities_are_listened_to(self, conditional_template_media_lights_sync, given_that, update_passed_args, assert_that):
+        template = "{{ states.sensor.tv_power.state | float > 50 and state_attr('media_player.tv', 'source') == 'Plex' }}"
+        with update_passed_args():
+            given_that.passed_arg('condition').is_set_to({"value_template": template})
+
+        for entity in ['sensor.tv_power', 'media_player.tv']:
+            assert_that(conditional_template_media_lights_sync).\
+                listens_to.state(entity, attribute='all').with_callback(conditional_template_media_lights_sync.invalidate_condition)
+        assert conditional_template_media_lights_sync.condition_cacheable
+
+    def test_template_is_rendered_once_per_change(self, conditional_template_media_lights_sync):
+        render_template = mock.Mock(return_value=True)
+        conditional_template_media_lights_sync.render_template = render_template
+
+        for _ in range(3):
+            assert conditional_template_media_lights_sync.can_change_colors() == True
+        conditional_template_media_lights_sync.invalidate_condition('sun.sun', 'all', None, None, None)
+        assert conditional_template_media_lights_sync.can_change_colors() == True
+
+        assert render_template.call_count == 2
+
+    @pytest.mark.parametrize("template", [
+        "{{ now().hour > 18 }}",
+        "{{ states.light | selectattr('state','eq','on') | list | count == 0 and is_state('sun.sun','below_horizon') }}",
+        "{{ expand('group.tv_lights') | selectattr('state', 'eq', 'on') | list | count > 0 }}",
+        "{{ area_entities('living_room') | count > 0 and is_state('sun.sun', 'below_horizon') }}",
+        "{{ states | selectattr('entity_id', 'search', 'tv') | list | count > 0 }}",
+    ])
+    def test_templates_with_unlistened_entities_are_not_cached(self, conditional_template_media_lights_sync, given_that, update_passed_args,
+                                                               template):
+        with update_passed_args():
+            given_that.passed_arg('condition').is_set_to({"value_template": template})
+
+        assert not conditional_template_media_lights_sync.condition_cacheable
+
 
 class TestFormatUrl:
     relative_url = "/api/media_player_proxy/media_player.tv_test"
@@ -353,3 +1503,19 @@ class TestFormatUrl:
         formatted_url = media_lights_sync.format_url(self.relative_url, "media_player.tv_test", PICTURE_ATTRIBUTES[0])
 
         assert formatted_url == ha_url
+
+
+class TestBenchmark:
+    def test_only_regressions_beyond_tolerance_are_reported(self):
+        baseline = {"default/2/jpeg_300": {"p50_ms": 10.0}, "KMeans/2/jpeg_300": {"p50_ms": 10.0}}
+        report = {"default/2/jpeg_300": {"p50_ms": 12.5}, "KMeans/2/jpeg_300": {"p50_ms": 12.6}, "Histogram/2/jpeg_300": {"p50_ms": 50.0}}
+
+        assert compare_to_baseline(report, baseline, 0.25) == ["KMeans/2/jpeg_300: p50 12.6 ms, baseline 10.0 ms"]
+        assert compare_to_baseline(report, baseline, 0.3) == []
+
+    def test_committed_baseline_has_latencies_of_known_methods(self):
+        with open(image_path("../../benchmarks/baseline.json")) as f:
+            baseline = json.load(f)
+
+        assert {key.split("/")[0] for key in baseline} <= set(QUANTIZATION_METHODS)
+        assert all(metrics["p50_ms"] <= metrics["max_ms"] for metrics in baseline.values())